@@ -1,7 +1,8 @@
+from concurrent.futures import ThreadPoolExecutor
 import csv
 from dataclasses import dataclass
 from datetime import datetime
-import json
+import io
 import math
 import os
 from os import path
@@ -9,24 +10,30 @@ import re
 import subprocess
 from subprocess import PIPE, STDOUT, TimeoutExpired
 import sys
-import time
+import threading
 from util import *
-import zipfile
 
 from exercises import *
 from models import *
 from program import *
+from recodex_api import *
+from response_cache import ResponseCache
+from sandbox import *
+from spec_index import *
 
 def usage():
     print(f'usage: py {sys.argv[0]} <model> [args...]')
     print('  -e <ext>: only evaluate exercises with the given language extension')
     print('  -i: let model make function calls to run code')
+    print('  -j <num>: evaluate up to <num> exercises concurrently')
     print('  -l <cs|en>: only evaluate exercises in the given language')
     print('  -m <num>: stop when exercise count reaches the given value')
     print('  -n: nudge for another program if evaluation fails')
+    print('  -nc: do not use cached model responses')
     print('  -ps: prompt that you are a strong programmer')
     print('  -pw: prompt that you are a weak programmer')
     print('  -s <num>: sample number')
+    print('  -t: stream responses, writing source files while the model is generating')
     print('  -v: verbose output')
     print('  -1: only evaluate one exercise, then exit')
     exit()
@@ -43,7 +50,8 @@ engine = get_engine(model)
 is_gpt = isinstance(engine, GPT)
 
 sample = 1
-interactive = nudge = only_one = prompt_strong = prompt_weak = verbose = False
+jobs = 1
+interactive = nudge = no_cache = only_one = prompt_strong = prompt_weak = stream = verbose = False
 only_ext = only_lang = None
 stop_count = -1
 
@@ -55,6 +63,10 @@ while i < len(sys.argv):
             only_ext = sys.argv[i]
         case '-i':
             interactive = True
+        case '-j':
+            i += 1
+            jobs = int(sys.argv[i])
+            assert jobs >= 1
         case '-l':
             i += 1
             only_lang = sys.argv[i]
@@ -63,6 +75,8 @@ while i < len(sys.argv):
             stop_count = int(sys.argv[i])
         case '-n':
             nudge = True
+        case '-nc':
+            no_cache = True
         case '-ps':
             prompt_strong = True
         case '-pw':
@@ -71,6 +85,8 @@ while i < len(sys.argv):
             i += 1
             sample = int(sys.argv[i])
             assert sample > 1
+        case '-t':
+            stream = True
         case '-v':
             verbose = True
         case '-1':
@@ -80,6 +96,15 @@ while i < len(sys.argv):
     i += 1
 
 assert not (nudge and interactive)
+assert not (stream and interactive), 'streaming is not available with function calls'
+assert not stream or is_gpt, 'streaming is only available for GPT models'
+
+if not no_cache:
+    engine.cache = ResponseCache()
+if stream:
+    engine.stream = True
+
+specs = SpecIndex()
 
 def extra_suffix():
     return '' if sample == 1 else f'_{sample}'
@@ -117,56 +142,22 @@ def open_results():
 
     return results, results_out
 
-def valid_attachment(name, size):
-    ext = path.splitext(name)[1]
-    return ext not in ['.jar', '.pdf', '.png', '.svg', '.zip'] and size < 8 * 1024
-
-def build_spec(e):
-    spec = read_all(f'exercises/data/{e.id}.md')
-    spec = re.sub(r'\(<?https://recodex[^)]*\)', '', spec)
-    tokens = engine.token_count(spec)
+def build_spec(e, prefix):
+    entry = specs.get(e.id, engine)
+    spec = entry['spec']
+    counts = entry['tokens'][engine.tokenizer]
+    tokens = prefix.tokens + counts['spec']
     if tokens > 0.9 * token_limit:
         return None, 0, 0
 
-    attach_dir = f'exercises/data/{e.id}'
-    if path.exists(attach_dir):
-        attachment_files = list(os.scandir(attach_dir))
-    else:
-        attachment_files = []
-
-    attachments = []
-    num_attachments = submitted_attachments = 0
-    for a in sorted(attachment_files, key = lambda a: a.name):
-        if (a.path.endswith('.zip')):
-            with zipfile.ZipFile(a.path) as zip:
-                for name in zip.namelist():
-                    if not name.endswith('/'):
-                        num_attachments += 1
-                        info = zip.getinfo(name)
-                        if valid_attachment(name, info.file_size):
-                            try:
-                                text = fix(str(zip.read(name), 'utf-8'))
-                            except UnicodeDecodeError:
-                                continue    # ignore binary file
-                            attachments.append((name, text))
-        else:
-            num_attachments += 1
-            if valid_attachment(a.name, a.stat().st_size):
-                try:
-                    text = read_all(a.path)
-                except UnicodeDecodeError:
-                    continue    # ignore binary file
-                attachments.append((a.name, text))
-    
-    for (name, text) in attachments:
-        attachment_text = f'\n=== {name} ===\n' + text
-        t = engine.token_count(attachment_text)
+    submitted_attachments = 0
+    for a, t in zip(entry['attachments'], counts['attachments']):
         if tokens + t < 0.7 * token_limit:
-            spec += attachment_text
+            spec += attachment_text(a['name'], a['text'])
             tokens += t
             submitted_attachments += 1
 
-    return spec, num_attachments, submitted_attachments
+    return spec, entry['num_attachments'], submitted_attachments
 
 def print_expression(ext, expr):
     match ext:
@@ -217,6 +208,12 @@ def source_with(named_sources, regexp):
             return name
     return None
 
+# The module that a Haskell source file declares, or None if it has no module header
+# (and so is the module Main).
+def haskell_module(source):
+    m = re.search(r'^module\s+([\w.]+)', source, re.M)
+    return m[1] if m else None
+
 def java_main_class(named_sources):
     for name, source in named_sources:
         cls = None
@@ -229,40 +226,44 @@ def java_main_class(named_sources):
 
 RUN_TIMEOUT = 20
 
-def run_program(named_sources, extension, input):
-    dir = 'run'
-    new_dir(dir)
+sandboxes = SandboxPool()
+compiled = CompileCache()
 
-    if extension == 'cs':
-         run('(cd run; dotnet new console; rm Program.cs)')
+def run_program(named_sources, extension, input):
+    with sandboxes.sandbox(extension) as dir:
+        return run_in_sandbox(dir, named_sources, extension, input)
 
+def run_in_sandbox(dir, named_sources, extension, input):
     for name, source in named_sources:
         write_to(f'{dir}/{name}', source)
 
     compile = None
     match extension:
         case 'c':
-            compile = '(cd run; gcc -Wall *.c)'
+            compile = f'(cd {dir}; gcc -Wall *.c)'
             cmd = './a.out'
         case 'cpp':
-            compile = '(cd run; g++ -Wall *.cpp)'
+            compile = f'(cd {dir}; g++ -Wall *.cpp)'
             cmd = './a.out'
         case 'cs':
-            compile = '(cd run; dotnet build)'
-            cmd = 'bin/Debug/net7.0/run'
+            compile = f'(cd {dir}; dotnet build)'
+            cmd = f'bin/Debug/net7.0/{DOTNET_PROJECT}'
         case 'hs':
             m = source_with(named_sources, r'(^|\n)main +=')
             if not m:
                 return "error: can't find main source file"
-            cmd = f'runghc {m}'
+            # ghc only links an executable for the module Main, unless told otherwise
+            module = haskell_module(dict(named_sources)[m])
+            main_is = f' -main-is {module}' if module not in [None, 'Main'] else ''
+            compile = f'(cd {dir}; ghc -O0 -outputdir build{main_is} -o main {m})'
+            cmd = './main'
         case 'java':
-            compile = '(cd run; javac *.java)'
+            compile = f'(cd {dir}; {sandboxes.javac()} *.java)'
             cls = java_main_class(named_sources)
             if not cls:
                 return "error: can't find main class"
             cmd = f'java {cls}'
         case 'pl':
-            shutil.copy('lang/wrapper.pl', dir)
             names = ' '.join(name for name, _ in named_sources)
             cmd = f'swipl -g recodex_main wrapper.pl {names}'
         case 'py':
@@ -271,7 +272,7 @@ def run_program(named_sources, extension, input):
             assert False, "can't run this program type"
 
     if compile:
-        err, output = run_with_exit_code(compile)
+        err, output = compiled.compile(dir, extension, named_sources, compile)
         if err > 0:
             return output
 
@@ -413,7 +414,15 @@ Follow these coding guidelines:
 
     return p
 
-def build_query(spec, prog_lang, prog_lang_id, extension):
+# The system prompt and few-shot examples that start every query in a language.
+# They depend only on the language (and on the options of this run), so each prefix
+# is built once, together with its token count.
+@dataclass
+class QueryPrefix:
+    messages: list
+    tokens: int
+
+def build_query_prefix(prog_lang, prog_lang_id, extension):
     system = prompt(prog_lang, prog_lang_id, extension)
     messages = [ engine.sys_message(system) ]
 
@@ -452,8 +461,39 @@ def build_query(spec, prog_lang, prog_lang_id, extension):
             messages.append(engine.assistant_message(named_solution))
 
     assert len(messages) > 1
-    messages.append(engine.user_message(spec))
-    return messages
+    return QueryPrefix(messages, engine.prompt_tokens(messages, None))
+
+query_prefixes = {}
+query_prefix_lock = threading.Lock()
+
+def query_prefix(prog_lang, prog_lang_id, extension):
+    key = (prog_lang, prog_lang_id, extension)
+    with query_prefix_lock:
+        if key not in query_prefixes:
+            query_prefixes[key] = build_query_prefix(prog_lang, prog_lang_id, extension)
+        return query_prefixes[key]
+
+def build_query(spec, prefix):
+    return prefix.messages + [engine.user_message(spec)]
+
+# Writes each source file of a streamed response as soon as the model has generated it.
+# extract() writes the same files again from the whole response; if it rejects the
+# response instead, discard() removes them.
+class FileWriter:
+    def __init__(self, dir):
+        self.dir = dir
+        self.names = []
+
+    def __call__(self, name, text):
+        if name and name not in self.names:
+            write_to(f'{self.dir}/{name}', text)
+            self.names.append(name)
+
+    def discard(self):
+        for name in self.names:
+            if path.exists(f'{self.dir}/{name}'):
+                os.remove(f'{self.dir}/{name}')
+        self.names = []
 
 def extract(model_out, dir):
     error = ''
@@ -487,59 +527,29 @@ MAX_QUERIES = 3
 
 recodex_system_user = 'ad3d451f-41ef-4c70-a234-094d743511f3'
 
-def recodex_query1(cmd):
-    delay = 1
-    while True:
-        ret, out, stderr = run_with_stderr(f'recodex {cmd}')
-        
-        if 'Temporary failure in name resolution' in stderr:
-            print('name resolution failure, retrying...')
-            delay *= 1.5
-        else:
-            return ret, out, stderr
-
-def recodex_query(cmd):
-    ret, out, stderr = recodex_query1(cmd)
-    if ret > 0:
-        print(stderr)
-        assert False, 'recodex command failed'
-    return out
+poller = EvaluationPoller()
 
 def submit_to_recodex(id, runtime, dir, program):
     paths = [f'{dir}/{name}' for name, _ in program]
     if runtime == 'cs-dotnet-core':
         paths.append('lang/global_implicit.cs')
              
-    for sol in json.loads(recodex_query(f'exercises get-ref-solutions --json {id}')):
+    client = recodex_client()
+    for sol in client.get_ref_solutions(id):
         if sol['authorId'] == recodex_system_user and sol['description'].startswith(model_prefix):
-            recodex_query(f'exercises delete-ref-solution {sol["id"]}')
-
-    cmd = ('exercises add-reference-solution ' +
-                f'-r {runtime} -e {id} -n {model} {" ".join(paths)}')
-    exit_code, stdout, stderr = recodex_query1(cmd)
-    if exit_code > 0:
-        print(stderr)
-        m = re.search(r'RuntimeError: Received error from API: (.*)\n', stderr)
-        assert m
-        assert 'You cannot create reference solutions' not in m[1]
-        return (None, m[1])
-
-    solution_id = stdout.strip()
-    if solution_id == '':
-        return (None, 'no solution id')
+            client.delete_ref_solution(sol['id'])
 
-    delay = 1
-    while True:
-        time.sleep(delay)
-        eval_json = recodex_query(f'exercises get-ref-solution-evaluations --json {solution_id}')
-        # print(eval_json)
-        eval_block = json.loads(eval_json)[0]
-        if eval_block['evaluationStatus'] != 'work-in-progress':
-            break
-        print('evaluation unavailable, retrying...')
-        delay *= 1.5
+    try:
+        solution_id = client.add_reference_solution(id, runtime, model, paths)
+    except RecodexError as e:
+        print(e)
+        assert 'You cannot create reference solutions' not in str(e)
+        return (None, str(e))
+
+    if not solution_id:
+        return (None, 'no solution id')
 
-    e = eval_block['evaluation']
+    e = poller.submit(solution_id).result()
     return (e, '') if e else (None, 'no evaluation')
 
 @dataclass
@@ -623,7 +633,7 @@ def add_nudge(eval, query):
     print(msg)
     query.append(engine.user_message(msg))
 
-def interact(cdir, gres, query):
+def interact(cdir, gres, query, program, extension, prog_lang_id):
     if gres.funcall != '':
         if gres.funcall == prog_lang_id:
             output = run_program(program, extension, gres.input)
@@ -674,32 +684,19 @@ def output_line(file, e, num_attachments, submitted_attachments, gresults, eval)
     file.write(line + '\n')
     file.flush()
 
-exercises = read_all_exercises()
-done, results_out = open_results()
-os.makedirs('solutions', exist_ok = True)
-
-for e in exercises:
-    if e.id in done or 'pascal' in e.runtime:
-        continue
-
-    (prog_lang, _, extension) = languages[e.runtime]
-    if only_ext and extension != only_ext or only_lang and e.lang != only_lang:
-        continue
-
-    count = len(done) + 1
-    if stop_count >= 0 and count > stop_count:
-        break
+def eval_exercise(e, count):
+    (prog_lang, prog_lang_id, extension) = languages[e.runtime]
     print(f'== [{count}] {e.name} ({prog_lang}) ==\n')
 
     dir = f'solutions/{model_boost()}/{e.id}'
     new_dir(dir)
 
-    spec, num_attachments, submitted_attachments = build_spec(e)
+    prefix = query_prefix(prog_lang, prog_lang_id, extension)
+    spec, num_attachments, submitted_attachments = build_spec(e, prefix)
     assert spec != None, 'specification is too long'
     print(spec)
 
-    (prog_lang, prog_lang_id, extension) = languages[e.runtime]
-    query = build_query(spec, prog_lang, prog_lang_id, extension)
+    query = build_query(spec, prefix)
 
     funs = functions(prog_lang, prog_lang_id, extension) if can_interact(extension) else None
 
@@ -718,14 +715,14 @@ for e in exercises:
             label = f'{count}'
 
         print(f'[{label}] querying {model}...')
-        gres = engine.query(seed(), query, funs, verbose)
-        gres.program = gres.program.replace('\r', '')
-        gres.program = '\n'.join(line for line in gres.program.split('\n')
-                                 if not line.startswith('```'))
+        writer = FileWriter(cdir)
+        gres = engine.query(seed(), query, funs, verbose, writer)
+        gres.program = clean_output(gres.program)
 
         gpt_results.append(gres)
         if gres.error:
             print(f'error: {gres.error}')
+            writer.discard()
             break
 
         print('\n** program: **\n' + gres.program)
@@ -753,6 +750,7 @@ for e in exercises:
 
         program, gres.error = extract(gres.program, cdir)
         if gres.error:
+            writer.discard()
             break
 
         programs.append(program)
@@ -772,22 +770,72 @@ for e in exercises:
             if interactive:
                 assert isinstance(gres, GptResult)
                 if gres.funcall != None:
-                    interact(cdir, gres, query)
+                    interact(cdir, gres, query, program, extension, prog_lang_id)
                 else:
                     break
 
+    # Results are buffered so that the main thread can write them in exercise order.
+    out = io.StringIO()
     i = 0
     while i < len(gpt_results):
         eval = evals[i] if i < len(evals) else None
         j = i + 1
         while j < len(programs) and programs[j] == programs[i]:
             j += 1
-        output_line(results_out, e, num_attachments, submitted_attachments,
+        output_line(out, e, num_attachments, submitted_attachments,
                     gpt_results[i : j], eval)
         i = j
-        
-    done.add(e.id)
+
+    return out.getvalue()
+
+exercises = read_all_exercises()
+done, results_out = open_results()
+os.makedirs('solutions', exist_ok = True)
+
+todo = []
+for e in exercises:
+    if e.id in done or 'pascal' in e.runtime:
+        continue
+
+    (_, _, extension) = languages[e.runtime]
+    if only_ext and extension != only_ext or only_lang and e.lang != only_lang:
+        continue
+
+    count = len(done) + len(todo) + 1
+    if stop_count >= 0 and count > stop_count:
+        break
+    todo.append((e, count))
     if only_one:
         break
 
+specs.build([e.id for e, _ in todo], engine)
+
+# On an error or Ctrl-C, cancel the exercises not yet started, wait for the ones still
+# running (they may already have been submitted to ReCodEx) and save the results of all
+# that finished, in order.  A second Ctrl-C stops without waiting.
+executor = ThreadPoolExecutor(max_workers = jobs)
+futures = [executor.submit(eval_exercise, e, count) for e, count in todo]
+try:
+    for (e, _), future in zip(todo, futures):
+        results_out.write(future.result())
+        results_out.flush()
+        done.add(e.id)
+except BaseException:
+    executor.shutdown(wait = False, cancel_futures = True)
+    try:
+        for (e, _), future in zip(todo, futures):
+            if e.id in done or future.cancelled():
+                continue
+            try:
+                row = future.result()
+            except Exception:
+                continue
+            results_out.write(row)
+            results_out.flush()
+            done.add(e.id)
+    finally:
+        results_out.close()
+    raise
+executor.shutdown()
+
 results_out.close()
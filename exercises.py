@@ -1,8 +1,15 @@
+from collections import defaultdict
+from collections.abc import Mapping
 import csv
 from dataclasses import dataclass
 import math
+import os
+import pickle
+import threading
 
-@dataclass
+from util import write_atomic
+
+@dataclass(slots = True)
 class Exercise:
     id: str
     name: str
@@ -14,25 +21,132 @@ class Exercise:
     avg_best_score: float
     refs_min_locs: float
 
-id_exercises = {}
-
 def to_float(s):
     return 0.0 if s == '' else float(s)
 
-with open(f'exercises/exercises.csv') as f:
-    for row in csv.DictReader(f):
-        id = row['id']
-        runtime = row['runtime']
-        course = row['course']
+def parse_exercise(row):
+    return Exercise(row['id'], row['name'], row['runtime'], row['locale'],
+                    int(row['text_length']), int(row['attachments_count']),
+                    row['course'],
+                    to_float(row['avg_best_score']), to_float(row['refs_min_locs']))
+
+# The exercises and courses, loaded on first use rather than at import time.  Parsed
+# exercises are kept in a pickled snapshot, which is reused as long as the mtimes of
+# the CSV files are unchanged.
+class Catalogue:
+    def __init__(self, exercises_file = 'exercises/exercises.csv',
+                 courses_file = 'exercises/courses.csv',
+                 cache_file = 'cache/exercises.pickle'):
+        self.exercises_file = exercises_file
+        self.courses_file = courses_file
+        self.cache_file = cache_file
+        self.lock = threading.Lock()
+        self.loaded = False
+
+    def stamp(self):
+        return [os.stat(self.exercises_file).st_mtime_ns, os.stat(self.courses_file).st_mtime_ns]
+
+    def read_snapshot(self, stamp):
+        try:
+            with open(self.cache_file, 'rb') as f:
+                snapshot = pickle.load(f)
+        except Exception:   # missing, or written by an incompatible version
+            return False
+        if snapshot['stamp'] != stamp:
+            return False
+        self._exercises = snapshot['exercises']
+        self._course_years = snapshot['course_years']
+        return True
+
+    def load(self):
+        with self.lock:
+            if self.loaded:
+                return
+            stamp = self.stamp()
+            if not self.read_snapshot(stamp):
+                with open(self.exercises_file) as f:
+                    self._exercises = { row['id'] : parse_exercise(row)
+                                        for row in csv.DictReader(f) }
+                with open(self.courses_file) as f:
+                    self._course_years = { row['course'] : float(row['year'])
+                                           for row in csv.DictReader(f) }
+
+                snapshot = { 'stamp' : stamp, 'exercises' : self._exercises,
+                             'course_years' : self._course_years }
+                def write(f):
+                    pickle.dump(snapshot, f, protocol = pickle.HIGHEST_PROTOCOL)
+                write_atomic(self.cache_file, write, binary = True)
+            self.loaded = True
+
+    @property
+    def exercises(self):
+        self.load()
+        return self._exercises
+
+    @property
+    def course_years(self):
+        self.load()
+        return self._course_years
+
+    # Exercises in file order.  Before the catalogue is loaded, rows are parsed only as
+    # far as the caller reads, so taking the first few exercises is cheap.
+    def iter(self):
+        if self.loaded:
+            yield from self._exercises.values()
+            return
+        with open(self.exercises_file) as f:
+            for row in csv.DictReader(f):
+                yield parse_exercise(row)
+
+    def index(self, key):
+        index = defaultdict(list)
+        for e in self.exercises.values():
+            index[key(e)].append(e)
+        return dict(index)
+
+    def by_runtime(self):
+        return self.index(lambda e: e.runtime)
+
+    def by_course(self):
+        return self.index(lambda e: e.course)
+
+    def by_year(self):
+        return self.index(lambda e: self.course_years[e.course])
+
+catalogue = Catalogue()
+
+# A read-only dict view of a catalogue attribute that loads the catalogue on first
+# access, so that importing this module stays cheap.
+class LazyMapping(Mapping):
+    def __init__(self, attr):
+        self.attr = attr
+
+    def data(self):
+        return getattr(catalogue, self.attr)
+
+    def __getitem__(self, key):
+        return self.data()[key]
+
+    def __iter__(self):
+        return iter(self.data())
+
+    def __len__(self):
+        return len(self.data())
+
+    def __contains__(self, key):
+        return key in self.data()
+
+    def keys(self):
+        return self.data().keys()
+
+    def items(self):
+        return self.data().items()
 
-        e = Exercise(id, row['name'], runtime, row['locale'],
-                        int(row['text_length']), int(row['attachments_count']),
-                        course,
-                        to_float(row['avg_best_score']), to_float(row['refs_min_locs']))
-        id_exercises[id] = e
+    def values(self):
+        return self.data().values()
 
-with open('exercises/courses.csv') as f:
-    course_years = dict((row['course'], float(row['year'])) for row in csv.DictReader(f))
+id_exercises = LazyMapping('exercises')
+course_years = LazyMapping('course_years')
 
 def exercise_len(e):
     n = e.text_length
@@ -1,31 +1,155 @@
+from collections import Counter, defaultdict
 from itertools import combinations, islice
+import multiprocessing
 import os
+import re
 import sys
+import zipfile
+import zlib
 
 from Levenshtein import distance
+import numpy as np
 
 from exercises import *
 import util
 
+SHINGLE = 5         # characters per shingle
+BANDS = 32          # LSH bands ...
+ROWS = 4            # ... of this many MinHash values each
+PRIME = (1 << 61) - 1
+MAX_POSTINGS = 20   # ignore cross-language features shared by more specs than this
+MIN_SHARED = 3      # cross-language pairs must share at least this many features
+
 czech = {}
 eng = {}
 
-n = int(sys.argv[1])
-for id, e in islice(id_exercises.items(), n):
+n = int(sys.argv[1]) if len(sys.argv) > 1 else None
+exercises = { e.id : e for e in islice(catalogue.iter(), n) }
+for id in exercises:
     for lang, map in [('cs', czech), ('en', eng)]:
         p = f'exercises/download-{lang}/{id}.md'
         if os.path.exists(p):
             map[id] = util.read_all(p)
 
-for map in [czech, eng]:
-    print('czech' if map == czech else 'english')
-    dist = []
-    for (id1, text1), (id2, text2) in combinations(map.items(), 2):
-        d = distance(text1, text2) / max(len(text1), len(text2))
-        dist.append((d, id1, id2))
-    dist.sort()
-    for d, id1, id2 in dist[:25]:
-        e1, e2 = id_exercises[id1], id_exercises[id2]
-        print(f'{d:.3f}:')
-        print(f'  {e1.name} ({id1})')
-        print(f'  {e2.name} ({id2})')
+rng = np.random.default_rng(1)
+hash_a = rng.integers(1, 1 << 31, BANDS * ROWS, dtype = np.uint64)
+hash_b = rng.integers(0, 1 << 31, BANDS * ROWS, dtype = np.uint64)
+
+def normalize(text):
+    return re.sub(r'\s+', ' ', util.strip_accents(text).lower())
+
+def shingles(text):
+    text = normalize(text)
+    hashes = {zlib.crc32(text[i : i + SHINGLE].encode('utf-8'))
+              for i in range(max(len(text) - SHINGLE + 1, 1))}
+    return np.fromiter(hashes, dtype = np.uint64)
+
+# MinHash signature: for each of the BANDS * ROWS hash functions, the minimum hash
+# value over all shingles.  Two texts agree in a position with probability equal
+# to the Jaccard similarity of their shingle sets.
+def signature(text):
+    x = shingles(text)
+    return ((np.outer(hash_a, x) + hash_b[:, None]) % PRIME).min(axis = 1)
+
+# Pairs of ids whose signatures agree in all rows of at least one band.
+def candidates(map):
+    buckets = defaultdict(list)
+    for id, text in map.items():
+        sig = signature(text)
+        for band in range(BANDS):
+            buckets[band, sig[band * ROWS : (band + 1) * ROWS].tobytes()].append(id)
+
+    pairs = set()
+    for ids in buckets.values():
+        for id1, id2 in combinations(ids, 2):
+            pairs.add((id1, id2) if id1 < id2 else (id2, id1))
+    return sorted(pairs)
+
+def pair_distance(pair):
+    map, id1, id2 = pair
+    text1, text2 = maps[map][id1], maps[map][id2]
+    return distance(text1, text2) / max(len(text1), len(text2)), id1, id2
+
+maps = { 'czech' : czech, 'english' : eng }
+
+def attachment_names(id):
+    dir = f'exercises/data/{id}'
+    if not os.path.exists(dir):
+        return []
+    names = []
+    for a in os.scandir(dir):
+        if a.name.endswith('.zip'):
+            try:
+                with zipfile.ZipFile(a.path) as zip:
+                    names += [os.path.basename(n) for n in zip.namelist() if not n.endswith('/')]
+            except zipfile.BadZipFile:
+                pass
+        else:
+            names.append(a.name)
+    return names
+
+# Features of a spec that do not depend on its language: the contents of its code
+# blocks (as a whole and line by line, which catches sample input and output),
+# its numeric literals and the names of its attachments.
+def features(id, text):
+    fs = set()
+    for block in re.findall(r'```[^\n]*\n(.*?)```', text, re.S):
+        block = block.strip()
+        if block:
+            fs.add('code:' + re.sub(r'\s+', ' ', block))
+        for line in block.split('\n'):
+            if len(line := line.strip()) > 2:
+                fs.add('line:' + line)
+    for num in re.findall(r'(?<![\w.])\d+(?:\.\d+)?(?![\w.])', text):
+        if len(num) > 1:
+            fs.add('num:' + num)
+    fs.update('file:' + name for name in attachment_names(id))
+    return { zlib.crc32(f.encode('utf-8')) for f in fs }
+
+# Pairs of a Czech and an English spec of different exercises, scored by the Jaccard
+# similarity of their feature sets.  An inverted index from features to Czech specs
+# finds the overlapping pairs without comparing every spec to every other one.
+def cross_language_pairs():
+    cs_features = { id : features(id, text) for id, text in czech.items() }
+    en_features = { id : features(id, text) for id, text in eng.items() }
+
+    postings = defaultdict(list)
+    for id, fs in cs_features.items():
+        for f in fs:
+            postings[f].append(id)
+    df = Counter(f for fs in en_features.values() for f in fs)
+
+    pairs = []
+    for id, fs in en_features.items():
+        shared = Counter()
+        for f in fs:
+            ids = postings.get(f, [])
+            if len(ids) + df[f] <= MAX_POSTINGS:
+                shared.update(ids)
+        for cs_id, n in shared.items():
+            if cs_id != id and n >= MIN_SHARED:
+                jaccard = n / (len(cs_features[cs_id]) + len(fs) - n)
+                pairs.append((jaccard, n, cs_id, id))
+    pairs.sort(reverse = True)
+    return pairs
+
+# Workers are forked, so they share the loaded texts and receive only ids.
+with multiprocessing.get_context('fork').Pool() as pool:
+    for name, map in maps.items():
+        print(name)
+        pairs = candidates(map)
+        print(f'{len(pairs)} candidate pairs')
+        dist = pool.map(pair_distance, [(name, id1, id2) for id1, id2 in pairs], chunksize = 64)
+        dist.sort()
+        for d, id1, id2 in dist[:25]:
+            e1, e2 = exercises[id1], exercises[id2]
+            print(f'{d:.3f}:')
+            print(f'  {e1.name} ({id1})')
+            print(f'  {e2.name} ({id2})')
+
+print('czech-english')
+for j, n, id1, id2 in cross_language_pairs()[:25]:
+    e1, e2 = exercises[id1], exercises[id2]
+    print(f'{j:.3f} ({n} shared):')
+    print(f'  {e1.name} ({id1}, cs)')
+    print(f'  {e2.name} ({id2}, en)')
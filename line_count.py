@@ -1,3 +1,11 @@
+from dataclasses import dataclass
+import multiprocessing
+import os
+import re
+import sys
+
+from program import languages
+
 c_comments = ('//', '/*', '*/')
 
 delim = {
@@ -13,24 +21,258 @@ delim = {
     'python3' : ('#', None, None)
 }
 
-def line_count(text, runtime, count_multi):
-    single, multi_start, multi_end = delim[runtime]
-    
-    in_multi = False
-
-    count = 0
-    for line in text.split('\n'):
-        line = line.strip()
-        if in_multi:
-            if line.endswith(multi_end):
-                in_multi = False
+# Comment openers that need more than the delimiter itself: in Haskell, "-->" is an
+# operator and "{-#" starts a pragma.
+comment_patterns = {
+    'haskell' : (r'--+(?![!#$%&*+./<=>?@\\^|~:])', r'\{-(?!#)')
+}
+
+# Haskell comments nest.
+nested = {'haskell'}
+
+c_strings = [r'"(?:[^"\\\n]|\\.)*"', r"'(?:[^'\\\n]|\\.)*'"]
+
+# Patterns for the string literals of each runtime, so that comment delimiters inside
+# strings are ignored.  Patterns that can span lines come first.
+strings = {
+    'arduino-gcc' : c_strings,
+    'c-gcc-linux' : c_strings,
+    'cs-dotnet-core' : [r'@"(?:[^"]|"")*"', r'"""[\s\S]*?"""'] + c_strings,
+    'cxx-gcc-linux' : c_strings,
+    'haskell' : [r'"(?:[^"\\\n]|\\.)*"', r"(?<![\w'])'(?:[^'\\\n]|\\[^'\n]+)'"],
+    'java' : [r'"""[\s\S]*?"""'] + c_strings,
+    'node-linux' : [r'`(?:[^`\\]|\\[\s\S])*`'] + c_strings,
+    'php-linux' : [r'"(?:[^"\\]|\\[\s\S])*"', r"'(?:[^'\\]|\\[\s\S])*'"],
+    'prolog' : [r"0'(?:''|\\.|[^\n])", r'"(?:[^"\\\n]|\\.)*"', r"'(?:[^'\\\n]|\\.|'')*'"],
+    'python3' : [r'"""(?:[^"\\]|\\[\s\S]|"(?!""))*"""', r"'''(?:[^'\\]|\\[\s\S]|'(?!''))*'''",
+                 r'"(?:[^"\\\n]|\\.)*"', r"'(?:[^'\\\n]|\\.)*'"]
+}
+
+# Openers of string literals that may span lines.
+multiline_strings = {
+    'cs-dotnet-core' : ['@"', '"""'],
+    'java' : ['"""'],
+    'node-linux' : ['`'],
+    'php-linux' : ['"', "'"],
+    'python3' : ['"""', "'''"]
+}
+
+@dataclass(slots = True)
+class LineCounts:
+    code: int = 0
+    comment: int = 0
+    blank: int = 0
+
+    def __add__(self, other):
+        return LineCounts(self.code + other.code, self.comment + other.comment,
+                          self.blank + other.blank)
+
+# A lexer for one runtime: a single regular expression that matches the next newline,
+# comment, string literal, run of whitespace or run of other code.  Most lines cannot
+# start a comment or string that continues on the next line, and those are classified
+# by their first characters alone, many lines at a time; the regular expression only
+# runs from a line that contains the opener of a multi-line comment or string.
+class Lexer:
+    def __init__(self, runtime, count_multi):
+        single, multi_start, multi_end = delim[runtime]
+        single_pattern, multi_pattern = comment_patterns.get(
+            runtime, (re.escape(single), multi_start and re.escape(multi_start)))
+        if not count_multi:
+            multi_start = multi_pattern = None
+
+        # characters that may start a comment or a string end a run of code
+        starts = {single[0]} | {p[p.index(')') + 1] if p.startswith('(?<') else p[0]
+                                for p in strings[runtime]}
+        if multi_start:
+            starts.add(multi_start[0])
+        special = re.escape(''.join(sorted(starts)))
+
+        # The end of a line, possibly with the rest of the line if it is plain code,
+        # so that most lines take a single match.
+        alternatives = [r'(?P<nl>[^\S\n]*\n)',
+                        rf'(?P<line>[^\S\n]*[^\s{special}][^\n{special}]*\n)',
+                        rf'(?P<single>{single_pattern}[^\n]*)']
+        if multi_pattern:
+            alternatives.append(rf'(?P<multi>{multi_pattern})')
+        alternatives += ['(?P<string>' + '|'.join(strings[runtime]) + ')',
+                         r'(?P<space>[^\S\n]+)', rf'(?P<code>[^\s{special}][^\n{special}]*|.)']
+        self.token = re.compile('|'.join(alternatives))
+
+        self.single = single
+        self.single_start = re.compile(single_pattern)
+        self.plain_single = runtime not in comment_patterns
+        self.starters = multiline_strings.get(runtime, []) + ([multi_start] if multi_start else [])
+
+        self.multi_start = multi_start
+        self.multi_end = multi_end
+        if runtime in nested and multi_start:
+            self.nesting = re.compile(f'{re.escape(multi_start)}|{re.escape(multi_end)}')
+        else:
+            self.nesting = None
+
+    # End of the multi-line comment whose opening delimiter ends at pos, or -1.
+    def comment_end(self, text, pos):
+        if not self.nesting:
+            i = text.find(self.multi_end, pos)
+            return -1 if i < 0 else i + len(self.multi_end)
+        depth = 1
+        for m in self.nesting.finditer(text, pos):
+            depth += 1 if m[0] == self.multi_start else -1
+            if depth == 0:
+                return m.end()
+        return -1
+
+    # Counts code, comment and blank lines.  A line is code if it has anything but
+    # whitespace outside comments, and a comment line if it has a comment but no code.
+    def count(self, text):
+        for s in self.starters:
+            if s in text:
+                break
         else:
-            if count_multi and multi_start and line.startswith(multi_start):
-                if not multi_end in line:
-                    in_multi = True
-            elif line != '' and not line.startswith(single):
-                count += 1
-
-    if in_multi:
-        print('warning: multi-line comment was not terminated')
-    return count
+            return LineCounts(*self.count_block(text))
+
+        counts = LineCounts()
+        pos = 0
+        while pos < len(text):
+            start = self.next_token_line(text, pos)
+            counts += LineCounts(*self.count_block(text[pos : start]))
+            pos = self.count_tokens(text, start, counts) if start < len(text) else start
+        return counts
+
+    # Start of the first line at or after pos that contains the opener of a multi-line
+    # comment or string, or the end of the text.
+    def next_token_line(self, text, pos):
+        end = len(text)
+        for s in self.starters:
+            i = text.find(s, pos, end)
+            if i >= 0:
+                end = i
+        if end == len(text):
+            return end
+        return text.rfind('\n', pos, end) + 1 or pos
+
+    # Counts whole lines, none of which continues on the next line: a line is a comment
+    # line if it starts with a single-line comment, and code if it starts with anything
+    # else but whitespace.  Returns the counts of code, comment and blank lines.
+    def count_block(self, block):
+        if not block:
+            return 0, 0, 0
+        lines = block.split('\n')
+        if block.endswith('\n'):
+            lines.pop()
+        blank = lines.count('') + sum(map(str.isspace, lines))
+        if self.single not in block:
+            comment = 0
+        elif self.plain_single:
+            comment = ('\n' + '\n'.join(map(str.lstrip, lines))).count('\n' + self.single)
+        else:
+            comment = sum(1 for line in lines if self.single_start.match(line.lstrip()))
+        return len(lines) - blank - comment, comment, blank
+
+    # Counts lines from the line starting at pos with the regular expression, up to the
+    # end of the first line that ends outside a comment or string.  Returns the
+    # position after that line.
+    def count_tokens(self, text, pos, counts):
+        code = comment = False
+
+        def end_line():
+            nonlocal code, comment
+            if code:
+                counts.code += 1
+            elif comment:
+                counts.comment += 1
+            else:
+                counts.blank += 1
+            code = comment = False
+
+        while pos < len(text):
+            m = self.token.match(text, pos)
+            kind = m.lastgroup
+            end = m.end()
+            if kind == 'nl':
+                end_line()
+                return end
+            elif kind == 'line':
+                code = True
+                end_line()
+                return end
+            elif kind == 'single':
+                comment = True
+            elif kind == 'code':
+                code = True
+            elif kind in ('multi', 'string'):
+                if kind == 'multi':
+                    end = self.comment_end(text, end)
+                    if end < 0:
+                        print('warning: multi-line comment was not terminated')
+                        end = len(text)
+                for i, line in enumerate(text[pos : end].split('\n')):
+                    if i > 0:
+                        end_line()
+                    if line.strip():
+                        if kind == 'multi':
+                            comment = True
+                        else:
+                            code = True
+            pos = end
+
+        if not text.endswith('\n'):
+            end_line()
+        return pos
+
+lexers = {}
+
+def lexer(runtime, count_multi):
+    key = (runtime, count_multi)
+    lex = lexers.get(key)
+    if lex == None:
+        lex = lexers[key] = Lexer(runtime, count_multi)
+    return lex
+
+def count_lines(text, runtime, count_multi = True):
+    return lexer(runtime, count_multi).count(text)
+
+# Lines of code in a source file, not counting blank lines and comments (or, unless
+# count_multi is set, only single-line comments).
+def line_count(text, runtime, count_multi):
+    return lexer(runtime, count_multi).count(text).code
+
+extension_runtimes = { ext : runtime for runtime, (_, _, ext) in languages.items() }
+
+def count_file(args):
+    file, count_multi = args
+    runtime = extension_runtimes[os.path.splitext(file)[1][1:]]
+    try:
+        with open(file) as f:
+            text = f.read()
+    except UnicodeDecodeError:
+        return file, None
+    return file, count_lines(text, runtime, count_multi)
+
+# Counts the lines of every source file under a directory tree in a pool of worker
+# processes, returning a dict from file path to LineCounts.  Files in a language we
+# don't know and files that are not valid UTF-8 are skipped.
+def count_tree(root, count_multi = True, jobs = None):
+    files = []
+    for dir, _, names in os.walk(root):
+        for name in names:
+            if os.path.splitext(name)[1][1:] in extension_runtimes:
+                files.append(os.path.join(dir, name))
+
+    with multiprocessing.Pool(jobs) as pool:
+        results = pool.map(count_file, [(file, count_multi) for file in files],
+                           chunksize = 64)
+    return { file : counts for file, counts in results if counts != None }
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print(f'usage: {sys.argv[0]} <dir>')
+        exit()
+
+    totals = {}
+    for file, counts in count_tree(sys.argv[1]).items():
+        ext = os.path.splitext(file)[1][1:]
+        totals[ext] = totals.get(ext, LineCounts()) + counts
+    print('ext,code,comment,blank')
+    for ext, c in sorted(totals.items()):
+        print(f'{ext},{c.code},{c.comment},{c.blank}')
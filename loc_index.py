@@ -0,0 +1,86 @@
+import json
+import multiprocessing
+import os
+
+from line_count import line_count
+from program import *
+from util import *
+
+# Bump this whenever the way lines are counted changes, to invalidate stored counts.
+LOC_VERSION = 2
+
+# Fewer changed solutions than this are counted without starting worker processes.
+POOL_MIN = 64
+
+def count_solution(args):
+    file, runtime = args
+    program = extract_sources(read_all(file))
+    return sum(line_count(source, runtime, False) for _, source in program)
+
+# Persistent index of lines of code in generated solutions, keyed by (model, sample,
+# exercise id).  Each entry records the size and mtime of the model output it was
+# counted from, and only solutions whose output changed are scanned again.
+class LocIndex:
+    def __init__(self, file = 'cache/loc_index.json'):
+        self.file = file
+        self.entries = {}
+        self.dirty = False
+        if os.path.exists(file):
+            with open(file) as f:
+                data = json.load(f)
+            if data.get('version') == LOC_VERSION:
+                self.entries = data['entries']
+
+    # The output file of a solution and its stamp, or None if there is no solution.
+    def stamp(self, model, sample, id):
+        suffix = '' if sample == 1 else f'_{sample}'
+        dir = f'solutions/{model}{suffix}/{id}'
+        for name in ['model_output', 'gpt_output']:
+            file = f'{dir}/{name}'
+            try:
+                st = os.stat(file)
+                return file, [name, st.st_size, st.st_mtime_ns]
+            except FileNotFoundError:
+                pass
+        return None
+
+    # Lines of code in a solution, or -1 if there is no solution.
+    def count(self, model, sample, id, runtime):
+        return self.count_all([(model, sample, id, runtime)])[0]
+
+    # Lines of code in each of a list of (model, sample, id, runtime) solutions.  When
+    # many solutions have changed, they are counted in a pool of worker processes.
+    def count_all(self, solutions, jobs = None):
+        counts = [-1] * len(solutions)
+        stale = []
+        for i, (model, sample, id, runtime) in enumerate(solutions):
+            found = self.stamp(model, sample, id)
+            if not found:
+                continue
+            file, stamp = found
+            key = f'{model}/{sample}/{id}'
+            entry = self.entries.get(key)
+            if entry and entry[:3] == stamp:
+                counts[i] = entry[3]
+            else:
+                stale.append((i, key, stamp, file, runtime))
+
+        args = [(file, runtime) for _, _, _, file, runtime in stale]
+        if len(stale) < POOL_MIN or (jobs or os.cpu_count()) == 1:
+            new_counts = list(map(count_solution, args))
+        else:
+            with multiprocessing.Pool(jobs) as pool:
+                new_counts = pool.map(count_solution, args, chunksize = 64)
+        for (i, key, stamp, _, _), count in zip(stale, new_counts):
+            self.entries[key] = stamp + [count]
+            counts[i] = count
+        if stale:
+            self.dirty = True
+        return counts
+
+    def save(self):
+        if not self.dirty:
+            return
+        data = { 'version' : LOC_VERSION, 'entries' : self.entries }
+        write_atomic(self.file, lambda f: json.dump(data, f))
+        self.dirty = False
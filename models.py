@@ -1,19 +1,26 @@
-from dataclasses import dataclass
+from abc import ABC, abstractmethod
+import asyncio
+from dataclasses import asdict, dataclass
 import json
 import pprint
+import threading
 import time
 from typing import cast
 
+import aiohttp
 import google.api_core.exceptions
 import openai
 from openai.error import APIError, InvalidRequestError, RateLimitError, ServiceUnavailableError
-from openai.error import Timeout
+from openai.error import APIConnectionError, Timeout
 from openai.openai_object import OpenAIObject
 import replicate
 import replicate.exceptions
 import tiktoken
 from vertexai.preview.language_models import CodeGenerationModel
 
+from program import SourceStream
+from ratelimit import RateLimiter
+from token_counter import *
 from util import *
 
 models = [('code-bison-32k', 'code-bison', 32 * 1024),
@@ -21,6 +28,19 @@ models = [('code-bison-32k', 'code-bison', 32 * 1024),
           ('gpt-3.5-turbo-1106', 'gpt-3.5', 16 * 1024),
           ('gpt-4-1106-preview', 'gpt-4', 128 * 1024)]
 
+# (requests per minute, tokens per minute); adjust these to the quotas of your accounts
+rate_limits = {
+    'code-bison-32k' : (60, 1_000_000),
+    'codellama-34b' : (600, 1_000_000),
+    'gpt-3.5-turbo-1106' : (3500, 160_000),
+    'gpt-4-1106-preview' : (500, 150_000)
+}
+
+# tokens reserved for a model's response before we know its actual length
+OUT_TOKENS_ESTIMATE = 1000
+
+MAX_RETRY_DELAY = 60.0
+
 def find_model(name):
     matches = [ms for ms in models if name in ms[0]]
     if len(matches) == 0:
@@ -46,10 +66,104 @@ class ModelResult:
     program: str = ''
     error: str = ''
 
-class TextModel:
-    def token_count(self, s):
-        return len(s) // 3
+    # for streamed responses
+    first_token_time: float = 0.0   # seconds until the first token arrived
+    tokens_per_sec: float = 0.0
+
+# Finds a stop sequence in text that arrives in chunks, in time linear in the length
+# of the text (the Knuth-Morris-Pratt automaton), even when the stop sequence is split
+# across chunks.
+class StopMatcher:
+    def __init__(self, stop):
+        self.stop = stop
+        self.failure = [0] * len(stop)
+        k = 0
+        for i in range(1, len(stop)):
+            while k > 0 and stop[i] != stop[k]:
+                k = self.failure[k - 1]
+            if stop[i] == stop[k]:
+                k += 1
+            self.failure[i] = k
+        self.matched = 0
+        self.length = 0
+
+    # Consumes the next chunk.  Returns the position in the whole text at which the
+    # first occurrence of the stop sequence begins, or -1 if it has not appeared yet.
+    def feed(self, chunk):
+        stop, failure, k = self.stop, self.failure, self.matched
+        for i, c in enumerate(chunk):
+            while k > 0 and c != stop[k]:
+                k = failure[k - 1]
+            if c == stop[k]:
+                k += 1
+                if k == len(stop):
+                    return self.length + i + 1 - len(stop)
+        self.matched = k
+        self.length += len(chunk)
+        return -1
+
+# All engines share one event loop, running in a background thread, so that queries
+# from any number of threads draw on the same rate limit budget.
+_loop = None
+_loop_lock = threading.Lock()
+
+def event_loop():
+    global _loop
+    with _loop_lock:
+        if _loop == None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target = _loop.run_forever, daemon = True).start()
+    return _loop
+
+class Engine(ABC):
+    result_class = ModelResult
+
+    def __init__(self, model):
+        self.name = model
+        self.limiter = RateLimiter(*rate_limits[model])
+        self.cache = None
+        self.counter = TokenCounter()
+
+    # name of the tokenizer behind token_count(), for caching counts
+    @property
+    def tokenizer(self):
+        return self.counter.name
 
+    def token_count(self, s):
+        return self.counter.count(s)
+
+    def token_counts(self, texts):
+        return self.counter.count_batch(texts)
+
+    # on_file(name, text), if given, may be called with each source file of the response
+    # as soon as it has been generated.  If the response then fails and is retried,
+    # on_file.discard() (if it exists) is called first to drop the files written so far.
+    def query(self, seed, messages, funs, verbose, on_file = None):
+        coroutine = self.query_async(seed, messages, funs, verbose, on_file)
+        return asyncio.run_coroutine_threadsafe(coroutine, event_loop()).result()
+
+    async def query_async(self, seed, messages, funs, verbose, on_file = None):
+        if not self.cache:
+            return await self.query_model(seed, messages, funs, verbose, on_file)
+
+        key = self.cache.key(self.name, seed, messages, funs)
+        if cached := self.cache.get(key):
+            print('using cached response')
+            if cached['message'] != None:
+                messages.append(cached['message'])
+            return self.result_class(**cached['result'])
+
+        n = len(messages)
+        result = await self.query_model(seed, messages, funs, verbose, on_file)
+        message = json.loads(json.dumps(messages[-1])) if len(messages) > n else None
+        self.cache.put(key, asdict(result), message)
+        return result
+
+    @abstractmethod
+    async def query_model(self, seed, messages, funs, verbose, on_file = None):
+        ...
+
+class TextModel(Engine):
     def sys_message(self, content):
         return content
     
@@ -65,11 +179,34 @@ class TextModel:
             print(prompt, end = '')
         return prompt
 
+    def prompt_tokens(self, messages, funs):
+        return self.token_count(''.join(messages))
+
+    async def query_model(self, seed, messages, funs, verbose, on_file = None):
+        # counting may run a tokenizer or call an API, so keep it off the event loop
+        in_tokens = await asyncio.to_thread(self.prompt_tokens, messages, funs)
+        estimate = in_tokens + OUT_TOKENS_ESTIMATE
+        await self.limiter.acquire(estimate)
+        try:
+            result = await asyncio.to_thread(self.query_blocking, seed, messages, funs, verbose)
+        except BaseException:
+            self.limiter.settle(estimate, 0)    # refund the failed query
+            raise
+        out_tokens = await asyncio.to_thread(self.token_count, result.program)
+        self.limiter.settle(estimate, in_tokens + out_tokens)
+        return result
+
+    @abstractmethod
+    def query_blocking(self, seed, messages, funs, verbose):
+        ...
+
 class Codey(TextModel):
     def __init__(self, model):
+        super().__init__(model)
         self.model = CodeGenerationModel.from_pretrained(model)
+        self.counter = vertex_counter(self.model, model)
 
-    def query(self, seed, messages, func, verbose):
+    def query_blocking(self, seed, messages, func, verbose):
         prompt = self.make_prompt(messages, verbose)
         try:
             response = self.model.predict(prompt, max_output_tokens = 5000).text
@@ -83,37 +220,68 @@ llama_versions = {
     'codellama-34b' : 'efbd2ef6feefb242f359030fa6fe08ce32bfced18f3868b2915db41d41251b46',
 }
 
+llama_tokenizers = {
+    'codellama-34b' : 'codellama/CodeLlama-34b-hf'
+}
+
 class Llama(TextModel):
     def __init__(self, model):
+        super().__init__(model)
         self.model = model
         self.version = llama_versions[model]
+        self.counter = hugging_face_counter(llama_tokenizers[model])
 
-    def query(self, seed, messages, func, verbose):
+    def query_blocking(self, seed, messages, func, verbose):
         sys_prompt = messages[0]
         if verbose:
             print(sys_prompt)
         prompt = self.make_prompt(messages[1:], verbose)
 
+        # Stream the output so that the prediction can be cancelled as soon as the model
+        # starts to write another exercise, rather than paying for tokens up to max_tokens.
+        start = time.time()
+        first_token = None
+        tokens = 0
+        chunks = []
+        matcher = StopMatcher('[EXERCISE]')
+        stop = -1
         try:
-            output = replicate.run(
-                f'meta/{self.model}:{self.version}',
-                input = { 'system_prompt': sys_prompt, 'prompt': prompt, 'max_tokens' : 5000 }
+            prediction = replicate.predictions.create(
+                version = self.version,
+                input = { 'system_prompt': sys_prompt, 'prompt': prompt, 'max_tokens' : 5000 },
+                stream = True
             )
-            s = ''
-            stop = '[EXERCISE]'
-            for c in output:
-                s += c
-                if stop in s[-20:]:
-                    i = s.index(stop)
-                    s = s[:i]
-                    break
+            for event in prediction.stream():
+                match event.event.value:
+                    case 'output':
+                        if first_token == None:
+                            first_token = time.time()
+                        tokens += 1
+                        chunks.append(event.data)
+                        if (stop := matcher.feed(event.data)) >= 0:
+                            prediction.cancel()
+                            break
+                    case 'error':
+                        prediction.reload()
+                        raise replicate.exceptions.ModelError(prediction)
         except replicate.exceptions.ModelError as e:
             message = e.args[0]
             if 'exceed context window' in message:
                 return ModelResult('', 'context window exceeded')
             raise e
-                
-        return ModelResult(s, '')
+
+        s = ''.join(chunks)
+        if stop >= 0:
+            s = s[:stop]
+
+        result = ModelResult(s, '')
+        if first_token != None:
+            result.first_token_time = first_token - start
+            elapsed = time.time() - first_token
+            result.tokens_per_sec = tokens / elapsed if elapsed > 0 else 0.0
+            print(f'first token after {result.first_token_time:.2f} s, ' +
+                  f'{result.tokens_per_sec:.1f} tokens/s')
+        return result
 
 openai.api_key_path = '../openai_api_key'
 
@@ -134,13 +302,15 @@ class GptResult(ModelResult):
 def message(role, content):
     return { 'role' : role, 'content' : content }
 
-class GPT:
+class GPT(Engine):
+    result_class = GptResult
+    stream = False      # stream responses without function calls
+
     def __init__(self, model):
+        super().__init__(model)
         self.model = model
         self.encoding = tiktoken.encoding_for_model(model)
-
-    def token_count(self, s):
-        return len(self.encoding.encode(s))
+        self.counter = TiktokenCounter(self.encoding)
 
     def sys_message(self, content):
         return message('system', content)
@@ -179,29 +349,103 @@ class GPT:
             else:
                 print(m['content'], end = '')
 
-    def query_gpt(self, seed, messages, funs):
+    def prompt_tokens(self, messages, funs):
+        texts = []
+        for m in messages:
+            texts.append(m.get('content') or '')
+            if f := m.get('function_call'):
+                texts.append(f['arguments'])
+        if funs:
+            texts.append(json.dumps(funs))
+        return 4 * len(messages) + sum(self.token_counts(texts))
+
+    # With stream set, returns the stream of response chunks, and the caller settles
+    # the rate limiter once the stream has been read.
+    # Sends a query, retrying after transient errors.  If read is given, the response is
+    # streamed and read(response) is part of each attempt, so that an error while reading
+    # the stream (e.g. a dropped connection) is retried too; its result is returned.
+    async def query_gpt(self, seed, messages, funs, read = None):
+        prompt_tokens = await asyncio.to_thread(self.prompt_tokens, messages, funs)
+        estimate = prompt_tokens + OUT_TOKENS_ESTIMATE
         delay = 1.0
         while True:
+            await self.limiter.acquire(estimate)
+            used = 0    # a failed attempt is refunded
             try:
                 args = { 'model' : self.model, 'messages' : messages, 'seed' : seed }
                 if funs:
                     args['functions'] = funs
-                response = openai.ChatCompletion.create(**args)
-                break
+                if read:
+                    args['stream'] = True
+                response = await openai.ChatCompletion.acreate(**args)
+                if read:
+                    gres = await read(response)
+                    used = gres.total_tokens
+                    return gres
+                response = cast(OpenAIObject, response)
+                used = int(response['usage']['total_tokens'])
+                return response
             except APIError:
                 print('API error, retrying...')
             except RateLimitError:
                 print('rate limit exceeded, retrying...')
+                self.limiter.pause(delay)
             except ServiceUnavailableError:
                 print('service unavailable, retrying...')
             except Timeout:
                 print('timeout error, retrying...')
-            time.sleep(delay)
-            delay *= 1.5
-            
-        return cast(OpenAIObject, response)
+            except (APIConnectionError, aiohttp.ClientError, asyncio.TimeoutError):
+                print('connection error, retrying...')
+            finally:
+                self.limiter.settle(estimate, used)
+            await asyncio.sleep(delay)
+            delay = min(delay * 1.5, MAX_RETRY_DELAY)
+
+    # Reads a streamed response, passing each source file to on_file as soon as it is
+    # complete, and closes the stream (ending generation) at the final "====" line.
+    # A stream reports no token usage, so we count the tokens ourselves.  If reading
+    # fails, the partial response is dropped and any files already passed to on_file
+    # are discarded.
+    async def read_stream(self, gres, response, messages, on_file):
+        start = time.time()
+        first_token = None
+        chunks = []
+        sources = SourceStream(on_file or (lambda name, text: None))
+        try:
+            async for chunk in response:
+                gres.fingerprint = chunk.get('system_fingerprint') or gres.fingerprint
+                content = chunk['choices'][0]['delta'].get('content')
+                if content:
+                    if first_token == None:
+                        first_token = time.time()
+                    chunks.append(content)
+                    if sources.feed(content):
+                        break
+        except BaseException:
+            if discard := getattr(on_file, 'discard', None):
+                discard()
+            raise
+        finally:
+            await response.aclose()
+        sources.close()
+
+        content = ''.join(chunks)
+        if sources.end != None:
+            content = content[:sources.end]
+        gres.in_tokens = await asyncio.to_thread(self.prompt_tokens, messages, None)
+        gres.out_tokens = await asyncio.to_thread(self.token_count, content)
+        gres.total_tokens = gres.in_tokens + gres.out_tokens
+
+        if first_token != None:
+            gres.first_token_time = first_token - start
+            elapsed = time.time() - first_token
+            gres.tokens_per_sec = gres.out_tokens / elapsed if elapsed > 0 else 0.0
+
+        messages.append(self.assistant_message(content))
+        gres.program = content
+        return gres
 
-    def query(self, seed, messages, funs, verbose):
+    async def query_model(self, seed, messages, funs, verbose, on_file = None):
         gres = GptResult()
 
         if verbose:
@@ -209,14 +453,20 @@ class GPT:
             if funs:
                 pp.pprint(funs)
 
+        read = None
+        if self.stream and not funs:
+            read = lambda response: self.read_stream(gres, response, messages, on_file)
         try:
-            response = self.query_gpt(seed, messages, funs)
+            response = await self.query_gpt(seed, messages, funs, read)
         except InvalidRequestError as e:
             if 'Detected an error in the prompt' in cast(str, e.user_message):
                 gres.error = 'prompt error'
                 return gres
             raise e
 
+        if read:
+            return response
+
         if verbose:
             pp.pprint(response)
 
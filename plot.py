@@ -1,20 +1,24 @@
 from collections import defaultdict
-import csv
 from dataclasses import dataclass
-from itertools import combinations
+import hashlib
+import inspect
+import json
+import math
 import matplotlib.pyplot as plt
 import matplotlib.ticker as mticker
+import multiprocessing
 import os
 import re
-from statistics import mean
+import sys
 
 import numpy as np
 
 from exercises import *
-from line_count import line_count
+from loc_index import LocIndex
 from models import find_model
 from program import *
 from results import *
+from results_store import *
 from util import *
 
 models = [find_model(n)[0] for n in ['llama', 'bison', 'gpt-3.5', 'gpt-4']]
@@ -22,28 +26,20 @@ models = [find_model(n)[0] for n in ['llama', 'bison', 'gpt-3.5', 'gpt-4']]
 def exclude_file(f):
     return 'best_of' in f or 'strong' in f or 'weak' in f
 
-files = os.listdir('results')
+store = ResultsStore()
 scores = defaultdict(lambda: defaultdict(list))
-all_results : dict[str, dict[str, list[Result]]] = defaultdict(lambda: defaultdict(list))
+tables : dict[str, list[ResultTable]] = defaultdict(list)
 trials = defaultdict(int)
 for model in models:
-    n = 1
-    while True:
-        base = model if n == 1 else f'{model}_{n}'
-        file = f'results/{base}.csv'
-        if not os.path.exists(file):
-            break
-        with open(file) as f:
-            results = list(map(parse_result, csv.DictReader(f)))
-        if len(results) != len(id_exercises):
-            print(f'warning: {file} has {len(results)} exercises, ' +
+    for table in store.sample_tables(model):
+        if len(table) != len(id_exercises):
+            print(f'warning: results/{table.name}.csv has {len(table)} exercises, ' +
                     f'but {len(id_exercises)} were expected; ignoring')
         else:
             trials[model] += 1
-            for r in results:
-                scores[r.id][model].append(r.score)
-                all_results[r.id][model].append(r)
-        n += 1
+            tables[model].append(table)
+            for id, score in zip(table.ids, table['score'].tolist()):
+                scores[id][model].append(score)
 
 @dataclass
 class Tally:
@@ -53,42 +49,102 @@ class Tally:
     def avg(self):
         return self.total_score / self.count
 
-def pass_at_k(n, c, k):
-    if n - c < k: return 1.0
-    return 1.0 - np.prod(1.0 - k / np.arange(n - c + 1, n + 1))
-
-def max_of(vals, k):
-    return mean(map(max, combinations(vals, k)))
+# For a row of n sorted scores, the i-th smallest score (counting from 1) is the maximum of
+# C(i - 1, k - 1) of the C(n, k) subsets of size k.  Row k - 1 of the result holds these
+# fractions, so that sorted scores @ weights.T gives avg@k for all k at once.
+def max_weights(n):
+    return np.array([[math.comb(i - 1, k - 1) / math.comb(n, k) for i in range(1, n + 1)]
+                     for k in range(1, n + 1)])
+
+# avg@k (expected best score of k samples) for each row of an exercises x samples matrix
+# and for k = 1 .. n, as an exercises x n matrix.
+def avg_at_k(vals):
+    n = vals.shape[1]
+    return np.sort(vals, axis = 1) @ max_weights(n).T
+
+# pass@k for each row of an exercises x samples matrix and k = 1 .. n, estimated as
+# 1 - C(n - c, k) / C(n, k) where c is the number of samples that passed.
+def pass_at_k(vals):
+    n = vals.shape[1]
+    table = np.array([[1.0 - math.comb(n - c, k) / math.comb(n, k) for k in range(1, n + 1)]
+                      for c in range(n + 1)])
+    return table[np.count_nonzero(vals == 1.0, axis = 1)]
+
+# For avg = True or False, maps model -> exercise id -> list of avg@k or pass@k for k = 1 .. n.
+def scores_at_k(avg):
+    result = defaultdict(dict)
+    for model in models:
+        ids = [id for id in scores if scores[id].get(model)]
+        if ids:
+            vals = np.array([scores[id][model] for id in ids])
+            table = avg_at_k(vals) if avg else pass_at_k(vals)
+            for id, row in zip(ids, table.tolist()):
+                result[model][id] = row
+    return result
 
 def model_avg_at(model, k):
     return f'{model} (avg@{k})' if k > 1 else model
 
-def group_by(f, all_by, avg):
-    groups = defaultdict(lambda: defaultdict(Tally))
-    for id in scores:
-        group = f(id)
-        for model, vals in scores[id].items():
-            match all_by:
-                case '1_to_n':
-                    by = range(1, trials[model] + 1)
-                case '1_and_n':
-                    by = {1, trials[model]}
-                case '1':
-                    by = [1]
-                case _:
-                    assert False
-
-            for k in by:
-                m = model_avg_at(model, k)
-                a = groups[group][m]
-                a.count += 1
-                if avg:
-                    score = max_of(vals, k)     # avg@n
-                else:
-                    score = pass_at_k(len(vals), vals.count(1.0), k)
-                a.total_score += score
+# Aggregation cube over (exercise, model, k, metric): for each metric (avg@k or pass@k)
+# and model, a matrix of scores with one row per exercise and one column per k, computed
+# once.  Groupings by course, year, language etc. are sums over slices of it.
+class Cube:
+    def __init__(self):
+        self.ids = list(scores)
+        self.models = [m for m in models if trials[m] > 0]
+        self.matrices = {}
+        for avg in [True, False]:
+            at_k = scores_at_k(avg)
+            for model in self.models:
+                m = np.full((len(self.ids), trials[model]), np.nan)
+                for i, id in enumerate(self.ids):
+                    if row := at_k[model].get(id):
+                        m[i] = row
+                self.matrices[avg, model] = m
+        self.memo = {}
+
+    def by(self, model, all_by):
+        match all_by:
+            case '1_to_n':
+                return range(1, trials[model] + 1)
+            case '1_and_n':
+                return sorted({1, trials[model]})
+            case '1':
+                return [1]
+            case _:
+                assert False
+
+    def group_by(self, f, all_by, avg):
+        keys = [f(id) for id in self.ids]
+        memo_key = (tuple(keys), all_by, avg)
+        if memo_key not in self.memo:
+            rows = defaultdict(list)
+            for i, key in enumerate(keys):
+                rows[key].append(i)
+
+            groups = {}
+            for key, key_rows in rows.items():
+                tallies = groups[key] = {}
+                for model in self.models:
+                    col = self.matrices[avg, model][key_rows]
+                    for k in self.by(model, all_by):
+                        vals = col[:, k - 1]
+                        vals = vals[~np.isnan(vals)].tolist()
+                        if vals:
+                            tallies[model_avg_at(model, k)] = (len(vals), sum(vals))
+            self.memo[memo_key] = groups
+
+        return defaultdict(lambda: defaultdict(Tally),
+                           { key : defaultdict(Tally, { m : Tally(*t) for m, t in tallies.items() })
+                             for key, tallies in self.memo[memo_key].items() })
+
+cube = None
 
-    return groups
+def group_by(f, all_by, avg):
+    global cube
+    if not cube:
+        cube = Cube()
+    return cube.group_by(f, all_by, avg)
 
 def save(name):
     plt.savefig(f'plots/{name}.svg')
@@ -285,22 +341,13 @@ def dist_gpt_scores(by, f):
 all_loc = defaultdict(lambda: defaultdict(list))
 
 def compute_all_loc():
-    for id in scores.keys():
-        runtime = id_exercises[id].runtime
-        for model in models:
-            for i in range(1, trials[model] + 1):
-                suffix = '' if i == 1 else f'_{i}'
-                dir = f'solutions/{model}{suffix}/{id}'
-                file = f'{dir}/model_output'
-                if not os.path.exists(file):
-                    file = f'{dir}/gpt_output'
-                if os.path.exists(file):
-                    text = read_all(file)
-                    program = extract_sources(text)
-                    count = sum(line_count(source, runtime, False) for _, source in program)
-                else:
-                    count = -1
-                all_loc[id][model].append(count)
+    index = LocIndex()
+    solutions = [(model, i, id, id_exercises[id].runtime)
+                 for id in scores.keys() for model in models
+                 for i in range(1, trials[model] + 1)]
+    for (model, _, id, _), count in zip(solutions, index.count_all(solutions)):
+        all_loc[id][model].append(count)
+    index.save()
 
 gpt4_loc = {}
 
@@ -446,9 +493,9 @@ def failure_bar():
     count = defaultdict(int)
     outcomes = defaultdict(lambda: defaultdict(int))
 
-    for id, result_map in all_results.items():
-        e = id_exercises[id]
-        for r in result_map[gpt4]:
+    for table in tables[gpt4]:
+        for r in table.results():
+            e = id_exercises[r.id]
             if r.score == 1.0:
                 outcome = 'passed'
             elif r.other_error > 0:
@@ -490,26 +537,149 @@ def failure_bar():
     plt.title('GPT-4 solution outcomes')
     save('failure_bar')
 
+# A figure, with the code it is drawn by and the inputs it reads, so that a figure is
+# only redrawn when one of them changes.  Code may include constants as well as
+# functions and classes; inputs are keys of input_digests().
+@dataclass
+class Figure:
+    draw: object
+    code: list
+    inputs: list
+
+# code behind every figure that groups scores with group_by
+grouping = [group_by, Cube, Tally, scores_at_k, avg_at_k, pass_at_k, max_weights, model_avg_at]
+
+figures = {
+    'exercises_by_year' : Figure(exercises_by_year, [year_index], ['exercises']),
+    'avg_all' : Figure(avg_over_all, [base_name] + grouping, ['scores']),
+    'avg_k' : Figure(avg_k, grouping, ['scores']),
+    'avg_by_year' : Figure(lambda: avg_by_year(False), [avg_by_year] + grouping,
+                           ['scores', 'exercises']),
+    'avg_by_year_all' : Figure(lambda: avg_by_year(True), [avg_by_year] + grouping,
+                               ['scores', 'exercises']),
+    'avg_by_course' : Figure(lambda: avg_by_course(False),
+                             [avg_by_course, year_ys, abbrev, abbrevs] + grouping,
+                             ['scores', 'exercises']),
+    'avg_by_course_full' : Figure(lambda: avg_by_course(True),
+                                  [avg_by_course, year_ys, abbrev, abbrevs] + grouping,
+                                  ['scores', 'exercises']),
+    'avg_by_prog_lang' : Figure(avg_by_prog_lang, grouping, ['scores', 'exercises']),
+    'score_vs_students' : Figure(score_vs_students, [], ['scores', 'exercises']),
+    'dist_by_year' : Figure(
+        lambda: dist_gpt_scores('year', lambda id: 'year ' + str(course_years[id_exercises[id].course])),
+        [dist_gpt_scores, bucket, buckets], ['scores', 'exercises']),
+    'dist_by_language' : Figure(
+        lambda: dist_gpt_scores('language', lambda id: language(id_exercises[id].runtime)),
+        [dist_gpt_scores, bucket, buckets], ['scores', 'exercises']),
+    'avg_by_loc' : Figure(avg_by_loc, [Tally], ['scores', 'loc']),
+    'score_vs_loc' : Figure(score_vs_loc, [kinds], ['scores', 'loc', 'exercises']),
+    'box_loc' : Figure(box_loc, [], ['scores', 'loc']),
+    'loc_vs_ref_loc_small' : Figure(
+        lambda: loc_vs_ref_loc(250, 230, 'loc_vs_ref_loc_small', False),
+        [loc_vs_ref_loc], ['scores', 'loc', 'exercises']),
+    'loc_vs_ref_loc_all' : Figure(
+        lambda: loc_vs_ref_loc(1200, 350, 'loc_vs_ref_loc_all', False),
+        [loc_vs_ref_loc], ['scores', 'loc', 'exercises']),
+    'failure_bar' : Figure(failure_bar, [year_ys, abbrev, abbrevs], ['results', 'exercises'])
+}
+
+STAMPS_FILE = 'plots/.stamps.json'
+
+def digest_files(h, files):
+    for file in files:
+        with open(file, 'rb') as f:
+            h.update(f.read())
+
+# A digest of each kind of input that figures read: the exercise metadata, the scores,
+# the lines of code of the solutions, and the full results files.
+def input_digests():
+    digests = {}
+    h = hashlib.sha256()
+    digest_files(h, ['exercises/exercises.csv', 'exercises/courses.csv'])
+    digests['exercises'] = h.hexdigest()
+    digests['scores'] = hashlib.sha256(json.dumps([scores, trials]).encode('utf-8')).hexdigest()
+    digests['loc'] = hashlib.sha256(json.dumps(all_loc).encode('utf-8')).hexdigest()
+    h = hashlib.sha256()
+    digest_files(h, [f'results/{table.name}.csv' for model in models for table in tables[model]])
+    digests['results'] = h.hexdigest()
+    return digests
+
+def source(obj):
+    return inspect.getsource(obj) if callable(obj) else repr(obj)
+
+# A digest of a figure's own code, the shared code that saves it, and its inputs.
+def figure_stamp(figure, digests):
+    h = hashlib.sha256()
+    for obj in [figure.draw, save] + figure.code:
+        h.update(source(obj).encode('utf-8'))
+    for input in figure.inputs:
+        h.update(digests[input].encode('utf-8'))
+    return h.hexdigest()
+
+def up_to_date(name, stamps, stamp):
+    return (stamps.get(name) == stamp and os.path.exists(f'plots/{name}.svg')
+            and os.path.exists(f'plots/pdf/{name}.pdf'))
+
+def render(name):
+    figures[name].draw()
+    return name
+
+def usage():
+    print(f'usage: py {sys.argv[0]} [args...]')
+    print('  -f: regenerate all figures, even if their inputs have not changed')
+    print('  -j <num>: render figures in <num> processes')
+    print('  --only <names>: only regenerate the given comma-separated figures')
+    exit()
+
+force = False
+jobs = os.cpu_count() or 1
+only = None
+
+i = 1
+while i < len(sys.argv):
+    match sys.argv[i]:
+        case '-f':
+            force = True
+        case '-j':
+            i += 1
+            jobs = int(sys.argv[i])
+        case '--only':
+            i += 1
+            only = sys.argv[i].split(',')
+            for name in only:
+                if name not in figures:
+                    print(f'unknown figure {name}')
+                    usage()
+        case _:
+            usage()
+    i += 1
+
 os.makedirs('plots/pdf', exist_ok = True)
 print('counting lines...')
 compute_all_loc()
 compute_gpt4_loc()
 print('done')
 
-exercises_by_year()
-avg_over_all()
-avg_k()
-avg_by_year(False)
-avg_by_year(True)
-avg_by_course(False)
-avg_by_course(True)
-avg_by_prog_lang()
-score_vs_students()
-dist_gpt_scores('year', lambda id: 'year ' + str(course_years[id_exercises[id].course]))
-dist_gpt_scores('language', lambda id: language(id_exercises[id].runtime))
-avg_by_loc()
-score_vs_loc()
-box_loc()
-loc_vs_ref_loc(250, 230, 'loc_vs_ref_loc_small', False)
-loc_vs_ref_loc(1200, 350, 'loc_vs_ref_loc_all', False)
-failure_bar()
+digests = input_digests()
+figure_stamps = { name : figure_stamp(f, digests) for name, f in figures.items() }
+stamps = {}
+if os.path.exists(STAMPS_FILE):
+    with open(STAMPS_FILE) as f:
+        stamps = json.load(f)
+
+if only:
+    names = only
+else:
+    names = [name for name in figures if force or not up_to_date(name, stamps, figure_stamps[name])]
+    if len(names) < len(figures):
+        print(f'{len(figures) - len(names)} figures are up to date')
+
+cube = Cube()    # build before forking so that every worker inherits it
+
+# Workers are forked, so they share all the data loaded above and need only a figure name.
+with multiprocessing.get_context('fork').Pool(min(jobs, max(len(names), 1))) as pool:
+    for name in pool.imap_unordered(render, names):
+        print(f'saved {name}')
+        stamps[name] = figure_stamps[name]
+
+write_atomic(STAMPS_FILE, lambda f: json.dump(stamps, f, indent = 2))
@@ -18,30 +18,134 @@ languages = {
 def language(r):
     return languages[r][0].split()[0]
 
-def extract_sources(program_text):
-    lines = program_text.split('\n')
-    program = []
+# A line that ends the current source file ("====") or starts a new one
+# ("=== name ===" or "Filename: name"); the separator is tried first.
+SOURCE_LINE = r'^(?:(=+)|(?: *=+ ?([^ \n]+) ?=+|[fF]ilename: ?(.*)))$'
+source_line = re.compile(SOURCE_LINE, re.M)
+source_line_bytes = re.compile(SOURCE_LINE.encode('ascii'), re.M)
 
-    filename = None
-    text = ''
+# Yields (name, text) for each source file in a model's output, which may be a str or
+# any bytes-like object such as an mmap of the output file (decoded as UTF-8).  Only the
+# header lines are matched; each file's text is sliced out of the output in one piece.
+def iter_sources(program_text):
+    if isinstance(program_text, str):
+        matcher, decode = source_line, lambda s: s
+    else:
+        matcher, decode = source_line_bytes, lambda b: str(b, 'utf-8')
+
+    def source(filename, text):
+        return (strip_accents(path.basename(decode(filename))), text)
 
-    def finish():
-        nonlocal filename
+    filename = None
+    start = 0
+    for m in matcher.finditer(program_text):
         if filename != None:
-            name_text = (strip_accents(path.basename(filename)), text)
-            program.append(name_text)
-            filename = None
-
-    for line in lines:
-        if re.fullmatch('=+', line):
-            finish()
-        elif m := re.fullmatch(r' *=+ ?([^ ]+) ?=+|[fF]ilename: ?(.*)', line):
-            finish()
-            filename = m[1] or m[2]
-            text = ''
-        else:
-            if filename != None:
-                text += line + '\n'
-
-    finish()
-    return program
+            yield source(filename, decode(program_text[start : m.start()]))
+        filename = m[2] if m[2] != None else m[3]
+        start = m.end() + 1
+
+    if filename != None:
+        # the output's last line gets a newline like every other line of a file
+        yield source(filename, decode(program_text[start:]) + '\n'
+                               if start <= len(program_text) else '')
+
+def extract_sources(program_text):
+    return list(iter_sources(program_text))
+
+# Removes carriage returns and Markdown code fence lines from a model's output.
+def clean_output(text):
+    text = text.replace('\r', '')
+    return '\n'.join(line for line in text.split('\n') if not line.startswith('```'))
+
+# Lines read past a "====" that ends a file before deciding that no other file follows.
+LOOKAHEAD_LINES = 2
+
+# Parses a model's output while it is being generated.  feed() takes the next chunk
+# of output and calls on_file(name, text) as soon as each source file is complete; it
+# returns True once the final "====" line has been seen, after which the rest of the
+# output is not needed, and end is then the length of the output up to and including
+# that line.  close() ends the output, completing any file still open.
+#
+# A "====" line may also just separate two files, so after one the stream reads up
+# to LOOKAHEAD_LINES more lines (not counting blank lines and further "===="), and
+# stops only if none of them starts another file.  Lines are cleaned as by clean_output(), so the files are the same as
+# extract_sources(clean_output(output)) finds in the output up to end.
+class SourceStream:
+    def __init__(self, on_file):
+        self.on_file = on_file
+        self.partial = []       # chunks of the current line
+        self.filename = None
+        self.lines = []
+        self.done = False
+        self.length = 0         # of the complete lines seen so far, with newlines
+        self.end = None
+        self.stop = None        # length up to the "====" that may be the final one
+        self.lookahead = 0
+
+    def feed(self, chunk):
+        if self.done:
+            return True
+        *complete, rest = chunk.split('\n')
+        for piece in complete:
+            self.partial.append(piece)
+            line = ''.join(self.partial)
+            self.partial = []
+            self.length += len(line) + 1
+            self.line(line)
+            if self.done:
+                return True
+        if rest:
+            self.partial.append(rest)
+        return False
+
+    def line(self, line):
+        line = line.replace('\r', '')
+        if line.startswith('```'):
+            return
+        m = source_line.fullmatch(line)
+        if m and m[1]:
+            if self.filename != None:
+                self.finish()
+                self.stop = self.length
+                self.lookahead = 0
+            return
+        elif m:
+            self.finish()
+            self.filename = m[2] if m[2] != None else m[3]
+            self.lines = []
+            self.stop = None
+        elif self.filename != None:
+            self.lines.append(line)
+
+        if self.stop != None and line.strip():
+            self.lookahead += 1
+            if self.lookahead >= LOOKAHEAD_LINES:
+                self.done = True
+                self.end = self.stop
+
+    def finish(self):
+        if self.filename != None:
+            text = ''.join(line + '\n' for line in self.lines)
+            self.on_file(strip_accents(path.basename(self.filename)), text)
+            self.filename = None
+
+    def close(self):
+        if not self.done:
+            self.line(''.join(self.partial))
+            self.finish()
+            self.done = True
+
+if __name__ == '__main__':
+    import time
+
+    # benchmark: a multi-megabyte output with many source files
+    files = 2000
+    body = ''.join(f'    int x{i} = {i};  // line {i}\n' for i in range(100))
+    output = 'Here is the program.\n' + ''.join(
+        f'=== file{i}.c ===\n{body}' for i in range(files)) + '====\n'
+    for name, text in [('str', output), ('bytes', output.encode('utf-8'))]:
+        start = time.time()
+        program = extract_sources(text)
+        t = time.time() - start
+        assert len(program) == files
+        print(f'{name}: {len(text) / 1e6:.1f} MB in {t * 1000:.1f} ms')
@@ -0,0 +1,50 @@
+import asyncio
+import time
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.level = per_minute
+        self.rate = per_minute / 60
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Seconds until the bucket holds the given amount.  A request larger than the
+    # whole bucket only waits for a full bucket, and then drives the level negative.
+    def wait_time(self, amount):
+        self.refill()
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+# Shared request and token budget for all queries to one model.  Callers reserve an
+# estimated token count before a query and settle it with the actual count afterwards.
+# The limiter must only be used from a single event loop.
+class RateLimiter:
+    def __init__(self, requests_per_min, tokens_per_min, margin = 0.9):
+        self.requests = TokenBucket(requests_per_min * margin)
+        self.tokens = TokenBucket(tokens_per_min * margin)
+        self.lock = asyncio.Lock()
+        self.paused_until = 0.0
+
+    async def acquire(self, tokens):
+        async with self.lock:       # waiters are served in FIFO order
+            while True:
+                delay = max(self.requests.wait_time(1), self.tokens.wait_time(tokens),
+                            self.paused_until - time.monotonic())
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+            self.requests.level -= 1
+            self.tokens.level -= tokens
+
+    def settle(self, estimated, actual):
+        self.tokens.refill()
+        self.tokens.level -= actual - estimated
+
+    # Stop admitting queries for a while, e.g. after the provider reports a rate limit error.
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
@@ -0,0 +1,172 @@
+from concurrent.futures import Future
+import os
+from os import path
+import threading
+import time
+
+import requests
+import requests.adapters
+import yaml
+
+MAX_RETRY_DELAY = 30.0
+
+# seconds to wait for a connection or for data from the API
+REQUEST_TIMEOUT = 60.0
+
+class RecodexError(RuntimeError):
+    pass
+
+# A long-lived, authenticated session with the ReCodEx API, replacing one `recodex`
+# CLI process per call.  By default the API URL and token are read from the recodex
+# CLI's context file; RECODEX_API_URL and RECODEX_API_TOKEN override them.
+class RecodexClient:
+    def __init__(self, api_url, api_token, pool_size = 16, timeout = REQUEST_TIMEOUT):
+        self.api_url = api_url.rstrip('/')
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = f'Bearer {api_token}'
+        adapter = requests.adapters.HTTPAdapter(pool_connections = 1, pool_maxsize = pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    @staticmethod
+    def from_context(context_file = '~/.local/share/recodex/context.yaml'):
+        context = {}
+        context_file = path.expanduser(context_file)
+        if path.exists(context_file):
+            with open(context_file) as f:
+                context = yaml.safe_load(f) or {}
+        api_url = os.environ.get('RECODEX_API_URL') or context.get('api_url')
+        api_token = os.environ.get('RECODEX_API_TOKEN') or context.get('api_token')
+        if not api_url or not api_token:
+            raise RecodexError('no ReCodEx API URL or token; log in with the recodex CLI first')
+        return RecodexClient(api_url, api_token)
+
+    # Requests are retried after a connection failure or a timeout unless retry is
+    # False, which callers pass for requests that must not be sent twice.
+    def request(self, method, url, retry = True, **kwargs):
+        delay = 1.0
+        while True:
+            try:
+                response = self.session.request(method, f'{self.api_url}/v1{url}',
+                                                timeout = self.timeout, **kwargs)
+                break
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if not retry:
+                    raise RecodexError(f'connection failure: {e}')
+                print('connection failure, retrying...')
+                time.sleep(delay)
+                delay = min(delay * 1.5, MAX_RETRY_DELAY)
+
+        try:
+            body = response.json()
+        except ValueError:
+            raise RecodexError(f'invalid response from API ({response.status_code})')
+        if not body.get('success'):
+            error = body.get('error') or {}
+            raise RecodexError(error.get('message', f'HTTP status {response.status_code}'))
+        return body['payload']
+
+    def get_ref_solutions(self, exercise_id):
+        return self.request('GET', f'/reference-solutions/exercise/{exercise_id}')
+
+    def get_ref_solution(self, solution_id):
+        return self.request('GET', f'/reference-solutions/{solution_id}')
+
+    def delete_ref_solution(self, solution_id):
+        return self.request('DELETE', f'/reference-solutions/{solution_id}')
+
+    def resubmit_ref_solution(self, solution_id):
+        return self.request('POST', f'/reference-solutions/{solution_id}/resubmit', retry = False)
+
+    def get_evaluations(self, solution_id):
+        return self.request('GET', f'/reference-solutions/{solution_id}/submissions')
+
+    # The file is read into memory so that a retried request sends it again in full.
+    def upload_file(self, file):
+        with open(file, 'rb') as f:
+            data = f.read()
+        return self.request('POST', '/uploaded-files',
+                            files = { 'file' : (path.basename(file), data) })['id']
+
+    # Returns the ID of the new reference solution.
+    def add_reference_solution(self, exercise_id, runtime, note, files):
+        data = {
+            'note' : note,
+            'files' : [self.upload_file(file) for file in files],
+            'runtimeEnvironmentId' : runtime
+        }
+        result = self.request('POST', f'/reference-solutions/exercise/{exercise_id}/submit',
+                              retry = False, json = data)
+        return result['referenceSolution']['id']
+
+_client = None
+_client_lock = threading.Lock()
+
+def recodex_client():
+    global _client
+    with _client_lock:
+        if _client == None:
+            _client = RecodexClient.from_context()
+    return _client
+
+# Polls the evaluations of all outstanding reference solutions in a single loop.
+# submit() returns a Future that receives the solution's evaluation (or None if
+# ReCodEx produced no evaluation) as soon as it is available.
+class EvaluationPoller:
+    def __init__(self, min_delay = 1.0, max_delay = MAX_RETRY_DELAY):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.pending : dict[str, Future] = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    def submit(self, solution_id):
+        future = Future()
+        with self.lock:
+            self.pending[solution_id] = future
+            self.wakeup.set()
+            if not self.thread:
+                self.thread = threading.Thread(target = self.run, daemon = True)
+                self.thread.start()
+        return future
+
+    def poll(self, solution_id):
+        eval_block = recodex_client().get_evaluations(solution_id)[0]
+        if eval_block['evaluationStatus'] == 'work-in-progress':
+            return False, None
+        return True, eval_block['evaluation']
+
+    def run(self):
+        delay = self.min_delay
+        while True:
+            self.wakeup.wait()
+            time.sleep(delay)
+
+            with self.lock:
+                ids = list(self.pending)
+
+            finished = False
+            for solution_id in ids:
+                try:
+                    done, evaluation = self.poll(solution_id)
+                except BaseException as e:
+                    with self.lock:
+                        self.pending.pop(solution_id).set_exception(e)
+                    continue
+                if done:
+                    with self.lock:
+                        self.pending.pop(solution_id).set_result(evaluation)
+                    finished = True
+
+            with self.lock:
+                waiting = len(self.pending)
+                if waiting == 0:
+                    self.wakeup.clear()
+
+            if finished or waiting == 0:
+                delay = self.min_delay
+            else:
+                print(f'{waiting} evaluations unavailable, retrying...')
+                delay = min(delay * 1.5, self.max_delay)
@@ -0,0 +1,30 @@
+import hashlib
+import json
+
+from util import write_atomic
+
+# Persistent cache of model responses, stored as one JSON file per query and keyed by
+# a hash of everything that determines the query: model, seed, messages and functions.
+class ResponseCache:
+    def __init__(self, dir = 'cache/responses'):
+        self.dir = dir
+
+    def key(self, model, seed, messages, funs):
+        data = json.dumps([model, seed, messages, funs], sort_keys = True, ensure_ascii = False)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def file(self, key):
+        return f'{self.dir}/{key[:2]}/{key}.json'
+
+    # Returns a dict with the fields of the stored result plus the response message
+    # that the query appended to the conversation (or None), or None on a miss.
+    def get(self, key):
+        try:
+            with open(self.file(key)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, result, message):
+        data = { 'result' : result, 'message' : message }
+        write_atomic(self.file(key), lambda f: json.dump(data, f, ensure_ascii = False))
@@ -0,0 +1,104 @@
+import csv
+from dataclasses import fields
+import os
+import pickle
+
+import numpy as np
+
+from results import *
+from util import write_atomic
+
+STRING_COLUMNS = ['id', 'name', 'runtime', 'lang']
+FLOAT_COLUMNS = ['score']
+INT_COLUMNS = ['num_attachments', 'submitted_attachments',
+               'in_tokens', 'out_tokens', 'total_tokens', 'tests', 'passed',
+               'compile_error', 'runtime_error', 'wrong_output',
+               'time_limit', 'memory_limit', 'other_error']
+
+# The rows of one results file, stored as one NumPy array per column.
+class ResultTable:
+    def __init__(self, name, results):
+        self.name = name
+        self.columns = {}
+        for c in STRING_COLUMNS:
+            self.columns[c] = np.array([getattr(r, c) for r in results], dtype = object)
+        for c in FLOAT_COLUMNS:
+            self.columns[c] = np.array([getattr(r, c) for r in results], dtype = np.float64)
+        for c in INT_COLUMNS:
+            self.columns[c] = np.array([getattr(r, c) for r in results], dtype = np.int64)
+
+        # files with repeated queries (-n, -i) have several rows per exercise
+        self.index = {}
+        for i, id in enumerate(self.columns['id']):
+            self.index.setdefault(id, i)
+
+    def __len__(self):
+        return len(self.columns['id'])
+
+    def __getitem__(self, column):
+        return self.columns[column]
+
+    @property
+    def ids(self):
+        return self.columns['id']
+
+    def column_for(self, column, ids):
+        rows = np.array([self.index[id] for id in ids], dtype = np.int64)
+        return self.columns[column][rows]
+
+    def results(self):
+        cols = { c : a.tolist() for c, a in self.columns.items() }
+        names = [f.name for f in fields(Result) if f.name != 'boosted']
+        return [Result(boosted = False, **{ c : cols[c][i] for c in names })
+                for i in range(len(self))]
+
+# All results files, loaded once into ResultTables.  Parsed tables are kept in a
+# binary cache file, and a table is reparsed only when its CSV file's mtime changes.
+class ResultsStore:
+    def __init__(self, dir = 'results', cache_file = 'cache/results.pickle'):
+        self.dir = dir
+        self.cache_file = cache_file
+        self.tables = {}
+        self.load()
+
+    def load(self):
+        cached = {}
+        if os.path.exists(self.cache_file):
+            try:
+                with open(self.cache_file, 'rb') as f:
+                    cached = pickle.load(f)
+            except Exception:   # e.g. written by another version of NumPy; just reparse
+                cached = {}
+
+        entries = {}
+        changed = False
+        for entry in os.scandir(self.dir):
+            if not entry.name.endswith('.csv'):
+                continue
+            name = entry.name[:-4]
+            mtime = entry.stat().st_mtime_ns
+            if name in cached and cached[name][0] == mtime:
+                table = cached[name][1]
+            else:
+                with open(entry.path) as f:
+                    table = ResultTable(name, list(map(parse_result, csv.DictReader(f))))
+                changed = True
+            entries[name] = (mtime, table)
+            self.tables[name] = table
+
+        if changed or entries.keys() != cached.keys():
+            write_atomic(self.cache_file,
+                         lambda f: pickle.dump(entries, f, protocol = pickle.HIGHEST_PROTOCOL),
+                         binary = True)
+
+    def table(self, name):
+        return self.tables[name]
+
+    # Tables for the samples of a model (or model with suffix): name, name_2, name_3, ...
+    def sample_tables(self, name):
+        tables = []
+        n = 1
+        while (base := name if n == 1 else f'{name}_{n}') in self.tables:
+            tables.append(self.tables[base])
+            n += 1
+        return tables
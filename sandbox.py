@@ -0,0 +1,187 @@
+from collections import defaultdict
+from contextlib import contextmanager
+import functools
+import glob
+import hashlib
+import json
+import os
+from os import path
+import re
+import shutil
+import tempfile
+import threading
+
+from util import *
+
+# build outputs that are kept between runs so that later builds are incremental
+KEEP = {
+    'cs' : ['bin', 'obj'],
+    'hs' : ['build']
+}
+
+# Name of the .NET project in every C# sandbox, and so of the program it builds.
+DOTNET_PROJECT = 'sandbox'
+
+# Class-data sharing archive of the classes that javac loads, in the pool's root
+# directory, so that every compile starts from a warm JVM.
+JAVAC_ARCHIVE = 'javac.jsa'
+
+# A pool of warm sandbox directories for running programs, one set per language
+# extension.  Each sandbox starts as a copy of a template directory that is initialized
+# once per extension (e.g. a restored .NET console project, or a JVM archive for
+# javac), and is reused after its sources are removed.  Every caller gets its own
+# directory, so programs can run concurrently.
+class SandboxPool:
+    def __init__(self, root = 'run'):
+        self.root = root
+        self.lock = threading.Lock()
+        self.free = defaultdict(list)
+        self.count = 0
+        self.templates = {}
+        self.template_lock = threading.Lock()
+        self.started = False
+
+    def template(self, extension):
+        with self.template_lock:
+            if extension not in self.templates:
+                dir = f'{self.root}/template-{extension}'
+                new_dir(dir)
+                match extension:
+                    case 'cs':
+                        run(f'(cd {dir}; dotnet new console -n {DOTNET_PROJECT} -o .; ' +
+                             'rm Program.cs; dotnet restore)')
+                    case 'java':
+                        write_to(f'{dir}/Warmup.java', 'class Warmup {}\n')
+                        run_with_exit_code(f'(cd {dir}; javac ' +
+                            f'-J-XX:ArchiveClassesAtExit=../{JAVAC_ARCHIVE} Warmup.java)')
+                        for name in ['Warmup.java', 'Warmup.class']:
+                            if path.exists(f'{dir}/{name}'):
+                                os.remove(f'{dir}/{name}')
+                    case 'pl':
+                        shutil.copy('lang/wrapper.pl', dir)
+                self.templates[extension] = (dir, set(os.listdir(dir)))
+            return self.templates[extension]
+
+    # The javac command for a sandbox, using the JVM archive if the JDK could create one.
+    def javac(self):
+        self.template('java')
+        if path.exists(f'{self.root}/{JAVAC_ARCHIVE}'):
+            return f'javac -J-XX:SharedArchiveFile=../{JAVAC_ARCHIVE}'
+        return 'javac'
+
+    def acquire(self, extension):
+        with self.lock:
+            if not self.started:
+                new_dir(self.root)
+                self.started = True
+            if self.free[extension]:
+                return self.free[extension].pop()
+            self.count += 1
+            dir = f'{self.root}/{extension}-{self.count}'
+
+        template_dir, _ = self.template(extension)
+        shutil.copytree(template_dir, dir, symlinks = True)
+        return dir
+
+    def release(self, extension, dir):
+        _, keep = self.template(extension)
+        keep = keep | set(KEEP.get(extension, []))
+        for entry in os.scandir(dir):
+            if entry.name not in keep:
+                if entry.is_dir(follow_symlinks = False):
+                    shutil.rmtree(entry.path)
+                else:
+                    os.remove(entry.path)
+
+        with self.lock:
+            self.free[extension].append(dir)
+
+    @contextmanager
+    def sandbox(self, extension):
+        dir = self.acquire(extension)
+        try:
+            yield dir
+        finally:
+            self.release(extension, dir)
+
+# compiled artifacts of each language, relative to the sandbox directory
+ARTIFACTS = {
+    'c' : ['a.out'],
+    'cpp' : ['a.out'],
+    'cs' : ['bin/Debug/net7.0'],
+    'hs' : ['main'],
+    'java' : ['*.class']
+}
+
+# commands that print the version of each language's compiler
+COMPILER_VERSION = {
+    'c' : 'gcc --version',
+    'cpp' : 'g++ --version',
+    'cs' : 'dotnet --version',
+    'hs' : 'ghc --version',
+    'java' : 'javac -version'
+}
+
+@functools.cache
+def compiler_version(extension):
+    _err, output = run_with_exit_code(COMPILER_VERSION[extension])
+    return output
+
+# Caches the result of compiling a program, keyed by the compile command, the compiler
+# version and a hash of the named sources.  On a hit the compiled artifacts are copied
+# into the sandbox and the compiler does not run at all.  A failed build is cached only
+# if it failed in the compiler itself, i.e. with a compile error (exit code 1), not if
+# the toolchain failed (a missing compiler, a crash or a NuGet restore error).
+class CompileCache:
+    def __init__(self, root = 'cache/compiled'):
+        self.root = root
+
+    # The sandbox directory in cmd differs between runs, so it is left out of the key.
+    def key(self, dir, extension, named_sources, cmd):
+        parts = [extension, cmd.replace(dir, ''), compiler_version(extension)]
+        for name, source in named_sources:
+            parts += [name, source]
+        h = hashlib.sha256()
+        for s in parts:
+            data = s.encode('utf-8')
+            h.update(len(data).to_bytes(8, 'little'))
+            h.update(data)
+        return h.hexdigest()
+
+    def cacheable(self, err, output):
+        return err == 0 or err == 1 and not re.search(r'\berror NU\d+', output)
+
+    def compile(self, dir, extension, named_sources, cmd):
+        entry = f'{self.root}/{self.key(dir, extension, named_sources, cmd)}'
+        if path.exists(entry):
+            with open(f'{entry}/result') as f:
+                result = json.load(f)
+            shutil.copytree(f'{entry}/files', dir, symlinks = True, dirs_exist_ok = True)
+            print(f'using cached build for {cmd}')
+            return result['exit_code'], result['output']
+
+        err, output = run_with_exit_code(cmd)
+        if not self.cacheable(err, output):
+            return err, output
+
+        os.makedirs(self.root, exist_ok = True)
+        tmp = tempfile.mkdtemp(dir = self.root)
+        files = f'{tmp}/files'
+        os.makedirs(files)
+        if err == 0:
+            for pattern in ARTIFACTS.get(extension, []):
+                for p in glob.glob(pattern, root_dir = dir):
+                    target = f'{files}/{p}'
+                    os.makedirs(path.dirname(target), exist_ok = True)
+                    if path.isdir(f'{dir}/{p}'):
+                        shutil.copytree(f'{dir}/{p}', target, symlinks = True)
+                    else:
+                        shutil.copy2(f'{dir}/{p}', target)
+        with open(f'{tmp}/result', 'w') as f:
+            json.dump({ 'exit_code' : err, 'output' : output }, f)
+        try:
+            os.rename(tmp, entry)
+        except OSError:     # another worker cached the same program first
+            shutil.rmtree(tmp)
+
+        return err, output
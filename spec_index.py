@@ -0,0 +1,120 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+from os import path
+import re
+import threading
+import zipfile
+
+from util import *
+
+def valid_attachment(name, size):
+    ext = path.splitext(name)[1]
+    return ext not in ['.jar', '.pdf', '.png', '.svg', '.zip'] and size < 8 * 1024
+
+def attachment_text(name, text):
+    return f'\n=== {name} ===\n' + text
+
+# Everything build_spec needs to know about an exercise, stored as one JSON file per
+# exercise: the cleaned spec, the total number of attachments, the name, size and text
+# of every attachment that may be submitted, and the token counts of the spec and of
+# each attachment for every tokenizer seen so far.  An entry is rebuilt when the spec
+# or any attachment file changes (by size or mtime); counts for a new tokenizer are
+# added to an existing entry without reading the exercise again.
+class SpecIndex:
+    def __init__(self, data_dir = 'exercises/data', dir = 'cache/specs'):
+        self.data_dir = data_dir
+        self.dir = dir
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def file(self, id):
+        return f'{self.dir}/{id}.json'
+
+    def stamp(self, id):
+        spec_file = f'{self.data_dir}/{id}.md'
+        st = os.stat(spec_file)
+        stamp = [[f'{id}.md', st.st_size, st.st_mtime_ns]]
+        attach_dir = f'{self.data_dir}/{id}'
+        if path.exists(attach_dir):
+            for a in sorted(os.scandir(attach_dir), key = lambda a: a.name):
+                st = a.stat()
+                stamp.append([a.name, st.st_size, st.st_mtime_ns])
+        return stamp
+
+    def scan(self, id, stamp):
+        spec = read_all(f'{self.data_dir}/{id}.md')
+        spec = re.sub(r'\(<?https://recodex[^)]*\)', '', spec)
+
+        attach_dir = f'{self.data_dir}/{id}'
+        attachment_files = list(os.scandir(attach_dir)) if path.exists(attach_dir) else []
+
+        attachments = []
+        num_attachments = 0
+        for a in sorted(attachment_files, key = lambda a: a.name):
+            if (a.path.endswith('.zip')):
+                with zipfile.ZipFile(a.path) as zip:
+                    for name in zip.namelist():
+                        if not name.endswith('/'):
+                            num_attachments += 1
+                            info = zip.getinfo(name)
+                            if valid_attachment(name, info.file_size):
+                                try:
+                                    text = fix(str(zip.read(name), 'utf-8'))
+                                except UnicodeDecodeError:
+                                    continue    # ignore binary file
+                                attachments.append(
+                                    { 'name' : name, 'size' : info.file_size, 'text' : text })
+            else:
+                num_attachments += 1
+                size = a.stat().st_size
+                if valid_attachment(a.name, size):
+                    try:
+                        text = read_all(a.path)
+                    except UnicodeDecodeError:
+                        continue    # ignore binary file
+                    attachments.append({ 'name' : a.name, 'size' : size, 'text' : text })
+
+        return { 'stamp' : stamp, 'spec' : spec, 'num_attachments' : num_attachments,
+                 'attachments' : attachments, 'tokens' : {} }
+
+    def save(self, id, entry):
+        write_atomic(self.file(id), lambda f: json.dump(entry, f, ensure_ascii = False))
+
+    # The index entry for an exercise, with token counts for the engine's tokenizer
+    # under entry['tokens'][engine.tokenizer] = { 'spec' : n, 'attachments' : [n, ...] }.
+    def get(self, id, engine):
+        with self.lock:
+            entry = self.entries.get(id)
+
+        if entry == None:
+            stamp = self.stamp(id)
+            try:
+                with open(self.file(id)) as f:
+                    entry = json.load(f)
+            except (FileNotFoundError, ValueError):
+                entry = None
+            changed = entry == None or entry['stamp'] != stamp
+            if changed:
+                entry = self.scan(id, stamp)
+        else:
+            changed = False
+
+        if engine.tokenizer not in entry['tokens']:
+            texts = [entry['spec']] + [attachment_text(a['name'], a['text'])
+                                       for a in entry['attachments']]
+            counts = engine.token_counts(texts)
+            entry['tokens'][engine.tokenizer] = { 'spec' : counts[0], 'attachments' : counts[1:] }
+            changed = True
+
+        if changed:
+            self.save(id, entry)
+        with self.lock:
+            self.entries[id] = entry
+        return entry
+
+    # Builds or refreshes the entries of the given exercises in parallel.
+    def build(self, ids, engine, jobs = None):
+        with ThreadPoolExecutor(max_workers = jobs or os.cpu_count()) as executor:
+            for _ in executor.map(lambda id: self.get(id, engine), ids):
+                pass
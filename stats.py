@@ -1,17 +1,24 @@
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 import csv
+from dataclasses import dataclass
 import itertools
+import multiprocessing
 import sys
 
 from exercises import *
 from models import *
 from program import *
 from results import *
+from results_store import *
 
 def usage():
     print(f'usage: py {sys.argv[0]} <model> [args...]')
+    print(f'       py {sys.argv[0]} -a <manifest> [args...]')
+    print(f'  -a <manifest>: generate statistics for every (model, suffix, boosted, best_of) in a CSV file')
     print(f'  -b <suffixes>: return best results from given files')
     print(f'  -i: use interactive results file')
+    print(f'  -j <num>: with -a, generate statistics in <num> processes')
     print(f'  -m <num>: only use first <num> results in computing statistics')
     print(f'  -n: use nudge results file')
     print(f'  -ps: use results file with strong prompt')
@@ -22,22 +29,32 @@ def usage():
 if len(sys.argv) < 2:
     usage()
 
-model = find_model(sys.argv[1])[0]
-is_gpt = model.startswith('gpt-')
+model = manifest = None
 suffix = ''
 boost = verbose = False
 best = None
 first_n = None
+jobs = 1
+
+i = 1
+if not sys.argv[1].startswith('-'):
+    model = find_model(sys.argv[1])[0]
+    i = 2
 
-i = 2
 while i < len(sys.argv):
     match sys.argv[i]:
+        case '-a':
+            i += 1
+            manifest = sys.argv[i]
         case '-b':
             i += 1
             best = sys.argv[i].split(',')
         case '-i':
             boost = True
             suffix = '_interact'
+        case '-j':
+            i += 1
+            jobs = int(sys.argv[i])
         case '-m':
             i += 1
             first_n = int(sys.argv[i])
@@ -54,6 +71,11 @@ while i < len(sys.argv):
             usage()
     i += 1
 
+if (model == None) == (manifest == None):
+    usage()
+
+store = ResultsStore()
+
 if first_n != None:
     only_ids = {e.id for e in read_all_exercises()[:first_n]}
 else:
@@ -67,98 +89,136 @@ def write_header(f, key, boosted):
             'compile_error,runtime_error,wrong_output,time_limit,mem_limit,' +
             'other_error\n')
 
-def write_stats(f, key_val, results, boosted):
-    count = len(results)
-    avg_score = sum(r.score for r in results) / count
-    tests = sum(r.tests for r in results)
+COUNTERS = ['boosted', 'tests', 'passed', 'compile_error', 'runtime_error', 'wrong_output',
+            'time_limit', 'memory_limit', 'other_error', 'in_tokens', 'out_tokens', 'total_tokens']
+
+# Running totals over a group of results.
+@dataclass
+class Stats:
+    count: int = 0
+    total_score: float = 0.0
+    boosted: int = 0
+    tests: int = 0
+    passed: int = 0
+    compile_error: int = 0
+    runtime_error: int = 0
+    wrong_output: int = 0
+    time_limit: int = 0
+    memory_limit: int = 0
+    other_error: int = 0
+    in_tokens: int = 0
+    out_tokens: int = 0
+    total_tokens: int = 0
 
-    passed = sum(r.passed for r in results)
-    compile_error = sum(r.compile_error for r in results)
-    runtime_error = sum(r.runtime_error for r in results)
-    wrong_output = sum(r.wrong_output for r in results)
-    time_limit = sum(r.time_limit for r in results)
-    memory_limit = sum(r.memory_limit for r in results)
-    other_error = sum(r.other_error for r in results)
+    def add(self, r):
+        self.count += 1
+        self.total_score += r.score
+        for c in COUNTERS:
+            setattr(self, c, getattr(self, c) + getattr(r, c))
+
+def write_stats(f, key_val, s, boosted):
+    avg_score = s.total_score / s.count
 
     def per(x):
-        p = 100 * x / tests
+        p = 100 * x / s.tests
         return f'{p:.1f}%'
 
-    f.write(f'{key_val},{count},')
+    f.write(f'{key_val},{s.count},')
     if boosted:
-        b = sum(r.boosted for r in results)
-        f.write(f'{b},')
-    f.write(f'{avg_score:.2f},{per(passed)},' +
-            f'{per(compile_error)},{per(runtime_error)},{per(wrong_output)},' +
-            f'{per(time_limit)},{per(memory_limit)},{per(other_error)}\n')
+        f.write(f'{s.boosted},')
+    f.write(f'{avg_score:.2f},{per(s.passed)},' +
+            f'{per(s.compile_error)},{per(s.runtime_error)},{per(s.wrong_output)},' +
+            f'{per(s.time_limit)},{per(s.memory_limit)},{per(s.other_error)}\n')
 
-def write_by(all_results, f, key, key_fun, boosted):
+def write_by(f, key, groups, boosted):
     f.write(f'\n=== by {key} ===\n\n')
     write_header(f, key, boosted)
 
-    for key_val in sorted(set(map(key_fun, all_results))):
-        write_stats(f, key_val, [r for r in all_results if key_fun(r) == key_val], boosted)
+    for key_val, s in sorted(groups.items()):
+        write_stats(f, key_val, s, boosted)
 
 def attachment_status(r):
     if r.num_attachments == 0:
         return 'none'
     return 'all' if r.submitted_attachments == r.num_attachments else 'partial'
 
-def get_results(suffix, boosted):
+def get_results(model, suffix, boosted):
     all_results = []
-    with open(f'results/{model}{suffix}.csv') as f:
-        for id, rows in itertools.groupby(map(parse_result, csv.DictReader(f)), lambda r: r.id):
-            if only_ids and id not in only_ids:
-                continue
-            rows = list(rows)
-            if boosted:
-                row = max(rows, key = lambda r: r.score)
-                row.boosted = row.score > rows[0].score
-                row.in_tokens = sum(r.in_tokens for r in rows) 
-                row.out_tokens = sum(r.out_tokens for r in rows) 
-                row.total_tokens = sum(r.total_tokens for r in rows) 
-            else:
-                row = rows[0]
-
-            all_results.append(row)
+    results = store.table(f'{model}{suffix}').results()
+    for id, rows in itertools.groupby(results, lambda r: r.id):
+        if only_ids and id not in only_ids:
+            continue
+        rows = list(rows)
+        if boosted:
+            row = max(rows, key = lambda r: r.score)
+            row.boosted = row.score > rows[0].score
+            row.in_tokens = sum(r.in_tokens for r in rows) 
+            row.out_tokens = sum(r.out_tokens for r in rows) 
+            row.total_tokens = sum(r.total_tokens for r in rows) 
+        else:
+            row = rows[0]
+
+        all_results.append(row)
     
     return all_results
 
 def prog_lang(r):
     return language(r.runtime).lower()
 
-def write_all_stats(f, all_results, boosted):
+def course_key(r):
+    course = id_exercises[r.id].course
+    return (course_years[course], course, prog_lang(r))
+
+GROUPINGS = [
+    ('language', lambda r: r.lang),
+    ('runtime', lambda r: r.runtime),
+    ('attachments', attachment_status),
+    ('course', course_key)
+]
+
+# Statistics over all results and over every grouping, accumulated in a single pass.
+class GroupedStats:
+    def __init__(self):
+        self.all = Stats()
+        self.groups = { key : defaultdict(Stats) for key, _ in GROUPINGS }
+
+    def add(self, r):
+        self.all.add(r)
+        for key, key_fun in GROUPINGS:
+            self.groups[key][key_fun(r)].add(r)
+
+def grouped_stats(results):
+    g = GroupedStats()
+    for r in results:
+        g.add(r)
+    return g
+
+def write_all_stats(f, g, boosted):
     f.write('\n=== all exercises ===\n\n')
     write_header(f, '', boosted)
-    write_stats(f, '(all)', all_results, boosted)
-
-    write_by(all_results, f, 'language', lambda r: r.lang, boosted)
-    write_by(all_results, f, 'runtime', lambda r: r.runtime, boosted)
-    write_by(all_results, f, 'attachments', attachment_status, boosted)
+    write_stats(f, '(all)', g.all, boosted)
 
-    by_course = defaultdict(list)
-    for r in all_results:
-        course = id_exercises[r.id].course
-        year = course_years[course]
-        by_course[(year, course, prog_lang(r))].append(r)
+    write_by(f, 'language', g.groups['language'], boosted)
+    write_by(f, 'runtime', g.groups['runtime'], boosted)
+    write_by(f, 'attachments', g.groups['attachments'], boosted)
 
     f.write(f'\n=== by course ===\n\n')
     write_header(f, 'course,year,prog_lang', boosted)
     
-    for (year, course, runtime), results in sorted(by_course.items()):
-        write_stats(f, f'{course},{year},{runtime}', results, boosted)
+    for (year, course, runtime), s in sorted(g.groups['course'].items()):
+        write_stats(f, f'{course},{year},{runtime}', s, boosted)
 
 first_suffix = f'_{first_n}' if first_n != None else ''
 
-def gen_stats(extra, boosted):
-    all_results = get_results(suffix, boosted)
+def gen_stats(model, suffix, extra, boosted):
+    g = grouped_stats(get_results(model, suffix, boosted))
 
     os.makedirs('stats', exist_ok = True)
     with open(f'stats/{model}{suffix}{extra}{first_suffix}.csv', 'w') as f:
-        if is_gpt:
-            in_tokens = sum(r.in_tokens for r in all_results)
-            out_tokens = sum(r.out_tokens for r in all_results)
-            total_tokens = sum(r.total_tokens for r in all_results)
+        if model.startswith('gpt-'):
+            in_tokens = g.all.in_tokens
+            out_tokens = g.all.out_tokens
+            total_tokens = g.all.total_tokens
             
             f.write('=== tokens ===\n\n')
             f.write(f'total_in_tokens,{in_tokens}\n')
@@ -171,47 +231,89 @@ def gen_stats(extra, boosted):
             f.write(f'"cost (GPT 3.5, 16K)",${cost_gpt_3_5:.2f}\n')
             f.write(f'"cost (GPT 4, 128K)",${cost_gpt_4:.2f}\n')
 
-        write_all_stats(f, all_results, boosted)
-
-if best:
-    result_map = defaultdict(list)
-    fieldnames = None
-    for suffix in best:
-        if suffix != '':
-            suffix = '_' + suffix
-        with open(f'results/{model}{suffix}.csv') as f:
-            reader = csv.DictReader(f)
-            if not fieldnames:
-                assert reader.fieldnames
-                fieldnames = list(reader.fieldnames)
-            for r in reader:
-                id = r['id']
-                if only_ids and id not in only_ids:
-                    continue
-                result_map[id].append(r)
-
-    assert fieldnames
-    s = fieldnames.index('score')
-    fieldnames.insert(s, 'scores')
-    full_name = f'{model}_best_of_{len(best)}{first_suffix}.csv'
-
-    with open(f'results/{full_name}', 'w') as f:
-        writer = csv.DictWriter(f, fieldnames)
+        write_all_stats(f, g, boosted)
+
+# Reads all the results files, sorts their rows into exercise order and writes best-of-N
+# results and statistics for every N from 2 to the number of files in a single pass.
+# Results files are usually not in evaluation order (exercises that failed are evaluated
+# again later), so all rows are read into memory and sorted once.  Rows of exercises no
+# longer in exercises.csv are skipped, since their statistics can't be grouped.
+def best_of(model, suffixes):
+    exercise_rank = { e.id : i for i, e in enumerate(read_all_exercises()) }
+    files = [f'results/{model}{"_" + s if s else ""}.csv' for s in suffixes]
+    with open(files[0]) as f:
+        fieldnames = csv.DictReader(f).fieldnames
+        assert fieldnames
+        fieldnames = list(fieldnames)
+    fieldnames.insert(fieldnames.index('score'), 'scores')
+
+    ns = range(min(2, len(files)), len(files) + 1)
+    full_names = { n : f'{model}_best_of_{n}{first_suffix}.csv' for n in ns }
+    outputs = { n : open(f'results/{full_names[n]}', 'w') for n in ns }
+    writers = { n : csv.DictWriter(outputs[n], fieldnames) for n in ns }
+    stats = { n : GroupedStats() for n in ns }
+    for writer in writers.values():
         writer.writeheader()
-        best_results = []
-        for id, results in result_map.items():
+
+    rows = []
+    for i, file in enumerate(files):
+        with open(file) as f:
+            for row in csv.DictReader(f):
+                id = row['id']
+                if id in exercise_rank and (not only_ids or id in only_ids):
+                    rows.append((exercise_rank[id], i, row))
+    rows.sort(key = lambda t: t[:2])    # stable, so each file's rows keep their order
+    for _, group in itertools.groupby(rows, key = lambda t: t[0]):
+        group = [(i, row) for _, i, row in group]
+        for n in ns:
+            results = [row for i, row in group if i < n]
+            if not results:
+                continue
             scores = [float(r['score']) for r in results]
-            max_score = max(scores)
-            i = scores.index(max_score)
-            best = results[i]
-            best['scores'] = str(scores)
-            writer.writerow(best)
-            best_results.append(parse_result(best))
-
-    with open(f'stats/{full_name}', 'w') as f:
-        write_all_stats(f, best_results, False)
-elif boost:
-    gen_stats('_pre', False)
-    gen_stats('', True)
+            best = results[scores.index(max(scores))]
+            writers[n].writerow(dict(best, scores = str(scores)))
+            stats[n].add(parse_result(best))
+
+    for n in ns:
+        outputs[n].close()
+        with open(f'stats/{full_names[n]}', 'w') as f:
+            write_all_stats(f, stats[n], False)
+
+def model_stats(model, suffix, boosted, best_n):
+    if best_n:
+        # the files of repeated runs are <model>.csv, <model>_2.csv, ..., <model>_<n>.csv
+        base = suffix[1:]
+        best_of(model, [base] + [f'{base}_{k}' if base else str(k)
+                                 for k in range(2, best_n + 1)])
+        return f'{model}{suffix}_best_of_2..{best_n}'
+    if boosted:
+        gen_stats(model, suffix, '_pre', False)
+        gen_stats(model, suffix, '', True)
+    else:
+        gen_stats(model, suffix, '', False)
+    return f'{model}{suffix}'
+
+# Each manifest row names a model, a results file suffix such as "nudge" (or nothing),
+# whether the file is boosted (1 or 0), and optionally a number N of repeated runs.
+# With N, the row generates best-of-2 to best-of-N results from the files of those runs.
+def read_manifest(file):
+    runs = []
+    with open(file) as f:
+        for row in csv.DictReader(f):
+            suffix = row['suffix']
+            best_n = int(row.get('best_of') or 0)
+            assert not (best_n and row['boosted'] == '1'), 'best-of runs cannot be boosted'
+            runs.append((find_model(row['model'])[0], '_' + suffix if suffix else '',
+                         row['boosted'] == '1', best_n))
+    return runs
+
+if manifest:
+    runs = read_manifest(manifest)
+    # Workers are forked, so they share the results store that is already loaded.
+    with ProcessPoolExecutor(jobs, mp_context = multiprocessing.get_context('fork')) as executor:
+        for future in [executor.submit(model_stats, *run) for run in runs]:
+            print(f'wrote stats for {future.result()}')
+elif best:
+    best_of(model, best)
 else:
-    gen_stats('', False)
+    model_stats(model, suffix, boost, 0)
@@ -0,0 +1,103 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import time
+
+import pytest
+
+import recodex_api
+from recodex_api import RecodexClient, RecodexError
+
+TIMEOUT = 0.2
+
+# A stub ReCodEx API that records each request and answers with the next action from
+# a script: 'drop' closes the connection without a response, 'stall' answers only after
+# the client has timed out, and anything else is sent back as the payload of a
+# successful response.
+class StubHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def handle_request(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        server = self.server
+        server.requests.append((self.command, self.path, body))
+        action = server.script.pop(0)
+        if action == 'drop':
+            self.close_connection = True
+            return
+        if action == 'stall':
+            time.sleep(2 * TIMEOUT)
+            self.close_connection = True
+            return
+        if isinstance(action, RecodexError):
+            reply = { 'success' : False, 'error' : { 'message' : str(action) } }
+        else:
+            reply = { 'success' : True, 'payload' : action }
+        data = json.dumps(reply).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = do_DELETE = handle_request
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(recodex_api.time, 'sleep', lambda seconds: None)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.requests = []
+    server.script = []
+    thread = threading.Thread(target = server.serve_forever, daemon = True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def client(server):
+    return RecodexClient(f'http://127.0.0.1:{server.server_port}', 'token', timeout = TIMEOUT)
+
+def test_get_retries_after_dropped_connection(server):
+    server.script = ['drop', [{ 'id' : 'sol' }]]
+    assert client(server).get_ref_solutions('ex') == [{ 'id' : 'sol' }]
+    assert [r[:2] for r in server.requests] == \
+        [('GET', '/v1/reference-solutions/exercise/ex')] * 2
+
+def test_get_retries_after_timeout(server):
+    server.script = ['stall', { 'id' : 'sol' }]
+    assert client(server).get_ref_solution('sol') == { 'id' : 'sol' }
+    assert len(server.requests) == 2
+
+def test_retried_upload_sends_whole_file(server, tmp_path):
+    file = tmp_path / 'main.py'
+    file.write_text('print("hello")\n')
+    server.script = ['drop', { 'id' : 'file-id' }]
+    assert client(server).upload_file(str(file)) == 'file-id'
+    assert len(server.requests) == 2
+    for _, _, body in server.requests:
+        assert b'filename="main.py"' in body
+        assert b'print("hello")\n' in body
+
+def test_submit_is_not_retried(server, tmp_path):
+    file = tmp_path / 'main.py'
+    file.write_text('pass\n')
+    server.script = [{ 'id' : 'file-id' }, 'drop']
+    with pytest.raises(RecodexError):
+        client(server).add_reference_solution('ex', 'python3', 'note', [str(file)])
+    assert [r[:2] for r in server.requests] == \
+        [('POST', '/v1/uploaded-files'), ('POST', '/v1/reference-solutions/exercise/ex/submit')]
+
+def test_submit_timeout_is_not_retried(server, tmp_path):
+    file = tmp_path / 'main.py'
+    file.write_text('pass\n')
+    server.script = [{ 'id' : 'file-id' }, 'stall']
+    with pytest.raises(RecodexError):
+        client(server).add_reference_solution('ex', 'python3', 'note', [str(file)])
+    assert len(server.requests) == 2
+
+def test_error_response_raises(server):
+    server.script = [RecodexError('not found')]
+    with pytest.raises(RecodexError, match = 'not found'):
+        client(server).get_ref_solution('sol')
@@ -0,0 +1,93 @@
+from collections import OrderedDict
+import hashlib
+import os
+import threading
+
+# Counts tokens for one tokenizer.  The counts of recently seen texts are kept in an
+# LRU cache keyed by a hash of the text, so that the same spec, attachment or prompt
+# is only tokenized once; texts that miss the cache are counted in one batch.
+# Subclasses override encode_counts() with a real tokenizer; this base class only
+# estimates, for models whose tokenizer is not available.
+class TokenCounter:
+    name = 'chars/3'
+
+    def __init__(self, size = 4096):
+        self.size = size
+        self.counts = OrderedDict()
+        self.lock = threading.Lock()
+
+    def count(self, text):
+        return self.count_batch([text])[0]
+
+    def count_batch(self, texts):
+        keys = [hashlib.blake2b(t.encode('utf-8'), digest_size = 16).digest() for t in texts]
+        counts = [0] * len(texts)
+        missing = {}
+        with self.lock:
+            for i, key in enumerate(keys):
+                if key in self.counts:
+                    self.counts.move_to_end(key)
+                    counts[i] = self.counts[key]
+                else:
+                    missing.setdefault(key, []).append(i)
+
+        if missing:
+            new_counts = self.encode_counts([texts[ixs[0]] for ixs in missing.values()])
+            with self.lock:
+                for (key, ixs), n in zip(missing.items(), new_counts):
+                    for i in ixs:
+                        counts[i] = n
+                    self.counts[key] = n
+                    self.counts.move_to_end(key)
+                while len(self.counts) > self.size:
+                    self.counts.popitem(last = False)
+        return counts
+
+    def encode_counts(self, texts):
+        return [len(t) // 3 for t in texts]
+
+class TiktokenCounter(TokenCounter):
+    def __init__(self, encoding):
+        super().__init__()
+        self.encoding = encoding
+        self.name = encoding.name
+
+    def encode_counts(self, texts):
+        if len(texts) == 1:
+            return [len(self.encoding.encode(texts[0]))]
+        return [len(tokens) for tokens in
+                self.encoding.encode_batch(texts, num_threads = os.cpu_count() or 8)]
+
+class HuggingFaceCounter(TokenCounter):
+    def __init__(self, tokenizer, name):
+        super().__init__()
+        self.tokenizer = tokenizer
+        self.name = name
+
+    def encode_counts(self, texts):
+        ids = self.tokenizer(texts, add_special_tokens = False)['input_ids']
+        return [len(i) for i in ids]
+
+# Counts tokens with a Vertex AI model's count_tokens() call, one text per request.
+class VertexCounter(TokenCounter):
+    def __init__(self, model, name):
+        super().__init__()
+        self.model = model
+        self.name = f'vertex/{name}'
+
+    def encode_counts(self, texts):
+        return [self.model.count_tokens(t).total_tokens for t in texts]
+
+# The tokenizer of a Hugging Face model if the optional transformers package is
+# installed and the tokenizer can be loaded, otherwise the character estimate.
+def hugging_face_counter(repo):
+    try:
+        from transformers import AutoTokenizer
+        return HuggingFaceCounter(AutoTokenizer.from_pretrained(repo), f'hf/{repo}')
+    except (ImportError, OSError, ValueError):
+        return TokenCounter()
+
+def vertex_counter(model, name):
+    if hasattr(model, 'count_tokens'):
+        return VertexCounter(model, name)
+    return TokenCounter()
@@ -2,6 +2,7 @@ import os
 from os import path
 import shutil
 import subprocess
+import threading
 from subprocess import PIPE, STDOUT
 import unicodedata
 
@@ -46,3 +47,19 @@ def read_all(filename):
 def write_to(filename, text):
     with open(filename, 'w') as f:
         f.write(text + '\n')
+
+# Calls write(f) on a temporary file that then replaces filename, so that readers in
+# other threads and processes never see a partly written file.
+def write_atomic(filename, write, binary = False):
+    dir = path.dirname(filename)
+    if dir:
+        os.makedirs(dir, exist_ok = True)
+    tmp = f'{filename}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(tmp, 'wb' if binary else 'w') as f:
+            write(f)
+        os.replace(tmp, filename)
+    except BaseException:
+        if path.exists(tmp):
+            os.remove(tmp)
+        raise